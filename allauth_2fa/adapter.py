@@ -1,14 +1,24 @@
 from __future__ import annotations
 
+import secrets
+
 from allauth.account.adapter import DefaultAccountAdapter
 from allauth.socialaccount.models import SocialLogin
+from asgiref.sync import sync_to_async
 from django.core.exceptions import PermissionDenied
 from django.http import HttpRequest
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 
+from allauth_2fa import app_settings
+from allauth_2fa.instrumentation import measure
+from allauth_2fa.utils import auser_has_valid_totp_device
+from allauth_2fa.utils import clear_pending_login
+from allauth_2fa.utils import get_device_ids
 from allauth_2fa.utils import get_next_query_string
+from allauth_2fa.utils import get_pending_login_cache
+from allauth_2fa.utils import get_pending_login_cache_key
 from allauth_2fa.utils import user_has_valid_totp_device
 
 try:
@@ -22,6 +32,13 @@ class OTPAdapter(DefaultAccountAdapter):
         """Returns True if the user has 2FA configured."""
         return user_has_valid_totp_device(user)
 
+    async def ahas_2fa_enabled(self, user) -> bool:
+        """Async version of `has_2fa_enabled`."""
+        if type(self).has_2fa_enabled is not OTPAdapter.has_2fa_enabled:
+            # Respect overrides of the sync version.
+            return await sync_to_async(self.has_2fa_enabled)(user)
+        return await auser_has_valid_totp_device(user)
+
     def pre_login(
         self,
         request: HttpRequest,
@@ -32,11 +49,16 @@ class OTPAdapter(DefaultAccountAdapter):
         if response:
             return response
 
-        # Require two-factor authentication if it has been configured.
-        if self.has_2fa_enabled(user):
-            self.stash_pending_login(request, user, kwargs)
-            redirect_url = self.get_2fa_authenticate_url(request)
-            raise ImmediateHttpResponse(response=HttpResponseRedirect(redirect_url))
+        with measure("pre_login") as measurement:
+            # Require two-factor authentication if it has been configured.
+            if self.has_2fa_enabled(user):
+                measurement.outcome = "2fa_required"
+                self.stash_pending_login(request, user, kwargs)
+                redirect_url = self.get_2fa_authenticate_url(request)
+                raise ImmediateHttpResponse(
+                    response=HttpResponseRedirect(redirect_url),
+                )
+            measurement.outcome = "2fa_not_enabled"
 
         # Otherwise defer to the original allauth adapter.
         return super().login(request, user)
@@ -70,10 +92,20 @@ class OTPAdapter(DefaultAccountAdapter):
         the caller expects, so we're going to make a shallow copy to prevent the
         caller from being impacted. Shallow is fine, as we're only setting new
         keys and not altering existing values.
+
+        The IDs of the user's devices are stored too, so that the token can be
+        verified against those devices only.
+
+        If `ALLAUTH_2FA_PENDING_LOGIN_CACHE` is set, the `login_kwargs` (which
+        may include a bulky serialized social login) are stored in that cache
+        instead, and the session only holds the key of the cache entry.
         """
+        # Forget any previous pending login (and its cache entry).
+        clear_pending_login(request.session)
         # Cast to string for the case when this is not a JSON serializable
         # object, e.g. a UUID.
         request.session["allauth_2fa_user_id"] = str(user.id)
+        request.session["allauth_2fa_device_ids"] = get_device_ids(user)
         login_kwargs = login_kwargs.copy()
         signal_kwargs = login_kwargs.get("signal_kwargs")
         if signal_kwargs:
@@ -82,10 +114,26 @@ class OTPAdapter(DefaultAccountAdapter):
                 signal_kwargs = signal_kwargs.copy()
                 signal_kwargs["sociallogin"] = sociallogin.serialize()
                 login_kwargs["signal_kwargs"] = signal_kwargs
-        request.session["allauth_2fa_login"] = login_kwargs
+        cache = get_pending_login_cache()
+        if cache is None:
+            request.session["allauth_2fa_login"] = login_kwargs
+        else:
+            key = secrets.token_urlsafe(16)
+            cache.set(
+                get_pending_login_cache_key(key),
+                login_kwargs,
+                app_settings.PENDING_LOGIN_CACHE_TIMEOUT,
+            )
+            request.session["allauth_2fa_login_key"] = key
 
     def unstash_pending_login_kwargs(self, request: HttpRequest) -> dict:
-        login_kwargs = request.session.pop("allauth_2fa_login", None)
+        login_kwargs = request.session.get("allauth_2fa_login")
+        key = request.session.get("allauth_2fa_login_key")
+        cache = get_pending_login_cache()
+        if key is not None and cache is not None:
+            login_kwargs = cache.get(get_pending_login_cache_key(key))
+        # The pending login is done with, one way or another.
+        clear_pending_login(request.session)
         if login_kwargs is None:
             raise PermissionDenied()
         signal_kwargs = login_kwargs.get("signal_kwargs")
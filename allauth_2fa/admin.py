@@ -0,0 +1,58 @@
+"""
+Helpers for showing and filtering by the 2FA status of users in the admin,
+without a query per user. For example:
+
+    from django.contrib import admin
+    from django.contrib.auth.admin import UserAdmin
+    from django.contrib.auth.models import User
+
+    from allauth_2fa.admin import TwoFactorStatusAdminMixin
+    from allauth_2fa.admin import TwoFactorStatusListFilter
+
+    class MyUserAdmin(TwoFactorStatusAdminMixin, UserAdmin):
+        list_display = [*UserAdmin.list_display, "has_2fa"]
+        list_filter = [*UserAdmin.list_filter, TwoFactorStatusListFilter]
+
+    admin.site.unregister(User)
+    admin.site.register(User, MyUserAdmin)
+"""
+
+from __future__ import annotations
+
+from django.contrib import admin
+from django.http import HttpRequest
+from django.utils.translation import gettext_lazy as _
+
+from allauth_2fa.utils import has_2fa_expression
+from allauth_2fa.utils import with_2fa_status
+
+
+class TwoFactorStatusListFilter(admin.SimpleListFilter):
+    """Filter users by whether they have 2FA enabled."""
+
+    title = _("two-factor authentication")
+    parameter_name = "has_2fa"
+
+    def lookups(self, request: HttpRequest, model_admin):
+        return [("yes", _("Enabled")), ("no", _("Disabled"))]
+
+    def queryset(self, request: HttpRequest, queryset):
+        if self.value() == "yes":
+            return queryset.filter(has_2fa_expression())
+        if self.value() == "no":
+            return queryset.filter(~has_2fa_expression())
+        return queryset
+
+
+class TwoFactorStatusAdminMixin:
+    """
+    Annotate the users in the admin with their 2FA status, and provide a
+    `has_2fa` column for `list_display` based on it.
+    """
+
+    def get_queryset(self, request: HttpRequest):
+        return with_2fa_status(super().get_queryset(request))
+
+    @admin.display(boolean=True, description=_("2FA"), ordering="has_2fa")
+    def has_2fa(self, obj) -> bool:
+        return obj.has_2fa
@@ -1,62 +1,126 @@
+"""
+The settings of django-allauth-2fa, e.g. `app_settings.FORMS` for the
+`ALLAUTH_2FA_FORMS` setting.
+
+The settings are resolved once, on first access, into an immutable
+`AppSettings` snapshot whose values are also set as the globals of this
+module, so reading them is a plain attribute lookup. The snapshot is refreshed
+when a setting is changed (e.g. with `override_settings` in tests).
+"""
+
 from __future__ import annotations
 
+from dataclasses import dataclass
+from dataclasses import fields
+from types import MappingProxyType
+from typing import Mapping
+
 from allauth.account import app_settings as allauth_settings
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
+SETTINGS_PREFIX = "ALLAUTH_2FA_"
 
-class _AppSettings:
-    @property
-    def TEMPLATE_EXTENSION(self) -> str:
-        return getattr(
-            settings,
-            "ALLAUTH_2FA_TEMPLATE_EXTENSION",
-            allauth_settings.TEMPLATE_EXTENSION,
-        )
 
-    @property
-    def ALWAYS_REVEAL_BACKUP_TOKENS(self) -> bool:
-        return bool(getattr(settings, "ALLAUTH_2FA_ALWAYS_REVEAL_BACKUP_TOKENS", True))
+@dataclass(frozen=True)
+class AppSettings:
+    TEMPLATE_EXTENSION: str
+    ALWAYS_REVEAL_BACKUP_TOKENS: bool
+    REMOVE_SUCCESS_URL: str
+    SETUP_SUCCESS_URL: str
+    FORMS: Mapping[str, str]
+    REQUIRE_OTP_ON_DEVICE_REMOVAL: bool
+    BACKUP_TOKENS_NUMBER: int
+    ASYNC_VIEWS: bool
+    SETUP_QR_CODE_INLINE: bool
+    SETUP_KEY_IN_SESSION: bool
+    METRICS_BACKEND: str
+    STATUS_CACHE: str | None
+    STATUS_CACHE_TIMEOUT: int
+    STATUS_TABLE: bool
+    PENDING_LOGIN_CACHE: str | None
+    PENDING_LOGIN_CACHE_TIMEOUT: int
+    RATE_LIMITER: str
+    RATE_LIMIT_ATTEMPTS: int
+    RATE_LIMIT_WINDOW: int
+    RATE_LIMIT_CACHE: str
+    TOTP_REPLAY_CACHE: str | None
+    TOTP_USAGE_FLUSH_INTERVAL: int
+    TOTP_USAGE_FLUSH_BATCH_SIZE: int
 
-    @property
-    def REMOVE_SUCCESS_URL(self) -> str:
-        return getattr(
-            settings,
-            "ALLAUTH_2FA_REMOVE_SUCCESS_URL",
-            "two-factor-setup",
-        )
+    @classmethod
+    def from_settings(cls) -> AppSettings:
+        def get(name, default):
+            return getattr(settings, f"{SETTINGS_PREFIX}{name}", default)
 
-    @property
-    def SETUP_SUCCESS_URL(self) -> str:
-        return getattr(
-            settings,
-            "ALLAUTH_2FA_SETUP_SUCCESS_URL",
-            "two-factor-backup-tokens",
+        return cls(
+            TEMPLATE_EXTENSION=get(
+                "TEMPLATE_EXTENSION",
+                allauth_settings.TEMPLATE_EXTENSION,
+            ),
+            ALWAYS_REVEAL_BACKUP_TOKENS=bool(get("ALWAYS_REVEAL_BACKUP_TOKENS", True)),
+            REMOVE_SUCCESS_URL=get("REMOVE_SUCCESS_URL", "two-factor-setup"),
+            SETUP_SUCCESS_URL=get("SETUP_SUCCESS_URL", "two-factor-backup-tokens"),
+            FORMS=MappingProxyType(dict(get("FORMS", {}))),
+            REQUIRE_OTP_ON_DEVICE_REMOVAL=get("REQUIRE_OTP_ON_DEVICE_REMOVAL", True),
+            BACKUP_TOKENS_NUMBER=get("BACKUP_TOKENS_NUMBER", 3),
+            ASYNC_VIEWS=bool(get("ASYNC_VIEWS", False)),
+            SETUP_QR_CODE_INLINE=bool(get("SETUP_QR_CODE_INLINE", True)),
+            SETUP_KEY_IN_SESSION=bool(get("SETUP_KEY_IN_SESSION", False)),
+            METRICS_BACKEND=get(
+                "METRICS_BACKEND",
+                "allauth_2fa.instrumentation.NullMetricsBackend",
+            ),
+            STATUS_CACHE=get("STATUS_CACHE", None),
+            STATUS_CACHE_TIMEOUT=get("STATUS_CACHE_TIMEOUT", 300),
+            STATUS_TABLE=bool(get("STATUS_TABLE", False)),
+            PENDING_LOGIN_CACHE=get("PENDING_LOGIN_CACHE", None),
+            PENDING_LOGIN_CACHE_TIMEOUT=get("PENDING_LOGIN_CACHE_TIMEOUT", 600),
+            RATE_LIMITER=get(
+                "RATE_LIMITER",
+                "allauth_2fa.ratelimit.NullRateLimiter",
+            ),
+            RATE_LIMIT_ATTEMPTS=get("RATE_LIMIT_ATTEMPTS", 10),
+            RATE_LIMIT_WINDOW=get("RATE_LIMIT_WINDOW", 300),
+            RATE_LIMIT_CACHE=get("RATE_LIMIT_CACHE", "default"),
+            TOTP_REPLAY_CACHE=get("TOTP_REPLAY_CACHE", None),
+            TOTP_USAGE_FLUSH_INTERVAL=get("TOTP_USAGE_FLUSH_INTERVAL", 60),
+            TOTP_USAGE_FLUSH_BATCH_SIZE=get("TOTP_USAGE_FLUSH_BATCH_SIZE", 100),
         )
 
-    @property
-    def FORMS(self) -> dict:
-        return getattr(settings, "ALLAUTH_2FA_FORMS", {})
 
-    @property
-    def REQUIRE_OTP_ON_DEVICE_REMOVAL(self) -> bool:
-        return getattr(
-            settings,
-            "ALLAUTH_2FA_REQUIRE_OTP_ON_DEVICE_REMOVAL",
-            True,
-        )
+_SETTING_NAMES = frozenset(field.name for field in fields(AppSettings))
+_snapshot: AppSettings | None = None
 
-    @property
-    def BACKUP_TOKENS_NUMBER(self) -> int:
-        return getattr(
-            settings,
-            "ALLAUTH_2FA_BACKUP_TOKENS_NUMBER",
-            3,
-        )
+
+def get_app_settings() -> AppSettings:
+    """Get the current settings snapshot, resolving it if needed."""
+    global _snapshot
+    if _snapshot is None:
+        snapshot = AppSettings.from_settings()
+        globals().update((name, getattr(snapshot, name)) for name in _SETTING_NAMES)
+        _snapshot = snapshot
+    return _snapshot
+
+
+def reset_app_settings() -> None:
+    """Forget the settings snapshot; it's resolved again on next access."""
+    global _snapshot
+    _snapshot = None
+    for name in _SETTING_NAMES:
+        globals().pop(name, None)
 
 
-_app_settings = _AppSettings()
+@receiver(setting_changed)
+def _reset_on_setting_changed(*, setting: str, **kwargs) -> None:
+    if setting.startswith(SETTINGS_PREFIX) or setting == "ACCOUNT_TEMPLATE_EXTENSION":
+        reset_app_settings()
 
 
 def __getattr__(name: str):
-    # See https://peps.python.org/pep-0562/ :)
-    return getattr(_app_settings, name)
+    # See https://peps.python.org/pep-0562/ :) This is only called until the
+    # snapshot's values have been set as the module's globals.
+    if name in _SETTING_NAMES:
+        return getattr(get_app_settings(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+from django.apps import AppConfig
+
+
+class AllauthTwoFactorConfig(AppConfig):
+    name = "allauth_2fa"
+    verbose_name = "django-allauth-2fa"
+
+    def ready(self) -> None:
+        # Connect the signal receivers and register the system checks.
+        from allauth_2fa import checks  # noqa: F401
+        from allauth_2fa import signals  # noqa: F401
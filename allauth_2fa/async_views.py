@@ -0,0 +1,124 @@
+"""
+Async versions of the views in `allauth_2fa.views`.
+
+These are used by `allauth_2fa.urls` when `ALLAUTH_2FA_ASYNC_VIEWS` is enabled.
+Database queries made by the views themselves use Django's async ORM; form
+validation and completing the login (which are implemented by django-otp and
+allauth) are still run in a thread.
+"""
+
+from __future__ import annotations
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.http import HttpResponseRedirect
+from django.shortcuts import redirect
+from django.views.generic import View
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+from allauth_2fa import app_settings
+from allauth_2fa.utils import aget_user
+from allauth_2fa.utils import aload_session
+from allauth_2fa.utils import auser_has_valid_totp_device
+from allauth_2fa.views import TwoFactorAuthenticate
+from allauth_2fa.views import TwoFactorBackupTokens
+from allauth_2fa.views import TwoFactorRemove
+from allauth_2fa.views import TwoFactorSetup
+
+
+class _AsyncFormViewMixin:
+    async def post(self, request, *args, **kwargs):
+        form = self.get_form()
+        if await sync_to_async(form.is_valid)():
+            return await sync_to_async(self.form_valid)(form)
+        return self.form_invalid(form)
+
+    async def put(self, *args, **kwargs):
+        return await self.post(*args, **kwargs)
+
+
+class AsyncTwoFactorAuthenticate(_AsyncFormViewMixin, TwoFactorAuthenticate):
+    async def dispatch(self, request, *args, **kwargs):
+        await aload_session(request.session)
+        if "allauth_2fa_user_id" not in request.session:
+            return redirect("account_login")
+        user_id = request.session["allauth_2fa_user_id"]
+        self.pending_user = await get_user_model().objects.aget(id=user_id)
+        return await View.dispatch(self, request, *args, **kwargs)
+
+    async def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+
+class AsyncTwoFactorSetup(_AsyncFormViewMixin, TwoFactorSetup):
+    async def dispatch(self, request, *args, **kwargs):
+        user = await aget_user(request)
+        if not user.is_authenticated:
+            return self.handle_no_permission()
+        # If the user has 2FA setup already, redirect them to the backup tokens.
+        if await auser_has_valid_totp_device(user):
+            return HttpResponseRedirect(self.get_success_url())
+        if app_settings.SETUP_KEY_IN_SESSION:
+            await aload_session(request.session)
+        return await View.dispatch(self, request, *args, **kwargs)
+
+    async def _anew_device(self):
+        """Async version of `_new_device`."""
+        if app_settings.SETUP_KEY_IN_SESSION:
+            self._new_device()
+            return
+        await self.request.user.totpdevice_set.filter(confirmed=False).adelete()
+        self.device = await TOTPDevice.objects.acreate(
+            user=self.request.user,
+            confirmed=False,
+        )
+
+    async def get(self, request, *args, **kwargs):
+        await self._anew_device()
+        # Looking up the current site may hit the database.
+        context = await sync_to_async(self.get_context_data)(**kwargs)
+        return self.render_to_response(context)
+
+    async def post(self, request, *args, **kwargs):
+        form = self.get_form()
+        if await sync_to_async(form.is_valid)():
+            return await sync_to_async(self.form_valid)(form)
+        # If the confirmation code was wrong, generate a new device.
+        await self._anew_device()
+        context = await sync_to_async(self.get_context_data)(form=form)
+        return self.render_to_response(context)
+
+
+class AsyncTwoFactorRemove(_AsyncFormViewMixin, TwoFactorRemove):
+    async def dispatch(self, request, *args, **kwargs):
+        user = await aget_user(request)
+        if not user.is_authenticated:
+            return self.handle_no_permission()
+        if not await auser_has_valid_totp_device(user):
+            return self.handle_missing_totp_device()
+        return await View.dispatch(self, request, *args, **kwargs)
+
+    async def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+
+class AsyncTwoFactorBackupTokens(TwoFactorBackupTokens):
+    async def dispatch(self, request, *args, **kwargs):
+        user = await aget_user(request)
+        if not user.is_authenticated:
+            return self.handle_no_permission()
+        if not await auser_has_valid_totp_device(user):
+            return self.handle_missing_totp_device()
+        return await View.dispatch(self, request, *args, **kwargs)
+
+    async def get(self, request, *args, **kwargs):
+        backup_tokens = [token async for token in self.get_backup_tokens()]
+        context = self.get_context_data(backup_tokens=backup_tokens, **kwargs)
+        return self.render_to_response(context)
+
+    async def post(self, request, *args, **kwargs):
+        # The async ORM doesn't support transactions.
+        backup_tokens = await sync_to_async(self.generate_backup_tokens)()
+        self.reveal_tokens = True
+        context = self.get_context_data(backup_tokens=backup_tokens, **kwargs)
+        return self.render_to_response(context)
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+from django.conf import settings
+from django.core.checks import Error
+from django.core.checks import register
+from django.utils.module_loading import import_string
+
+from allauth_2fa.app_settings import AppSettings
+
+FORM_IDS = ("authenticate", "setup", "remove")
+
+
+@register()
+def check_settings(app_configs, **kwargs) -> list[Error]:
+    """Validate the `ALLAUTH_2FA_*` settings."""
+    try:
+        app_settings = AppSettings.from_settings()
+    except (TypeError, ValueError) as exc:
+        return [
+            Error(
+                f"Invalid django-allauth-2fa settings: {exc}",
+                id="allauth_2fa.E001",
+            ),
+        ]
+
+    errors = []
+    unknown_form_ids = set(app_settings.FORMS) - set(FORM_IDS)
+    if unknown_form_ids:
+        errors.append(
+            Error(
+                f"ALLAUTH_2FA_FORMS has unknown keys: {sorted(unknown_form_ids)}",
+                hint=f"The valid keys are {list(FORM_IDS)}.",
+                id="allauth_2fa.E002",
+            ),
+        )
+    for name in (
+        "BACKUP_TOKENS_NUMBER",
+        "RATE_LIMIT_ATTEMPTS",
+        "RATE_LIMIT_WINDOW",
+        "TOTP_USAGE_FLUSH_INTERVAL",
+        "TOTP_USAGE_FLUSH_BATCH_SIZE",
+    ):
+        value = getattr(app_settings, name)
+        if not isinstance(value, int) or value < 1:
+            errors.append(
+                Error(
+                    f"ALLAUTH_2FA_{name} must be a positive integer.",
+                    id="allauth_2fa.E003",
+                ),
+            )
+    for name in (
+        "STATUS_CACHE",
+        "PENDING_LOGIN_CACHE",
+        "RATE_LIMIT_CACHE",
+        "TOTP_REPLAY_CACHE",
+    ):
+        alias = getattr(app_settings, name)
+        if alias and alias not in settings.CACHES:
+            errors.append(
+                Error(
+                    f"ALLAUTH_2FA_{name} refers to an unknown cache {alias!r}.",
+                    hint="Use one of the aliases in the CACHES setting.",
+                    id="allauth_2fa.E004",
+                ),
+            )
+    for name in ("STATUS_CACHE_TIMEOUT", "PENDING_LOGIN_CACHE_TIMEOUT"):
+        timeout = getattr(app_settings, name)
+        if timeout is not None and not isinstance(timeout, int):
+            errors.append(
+                Error(
+                    f"ALLAUTH_2FA_{name} must be an integer or None.",
+                    id="allauth_2fa.E005",
+                ),
+            )
+    for name in ("METRICS_BACKEND", "RATE_LIMITER"):
+        try:
+            import_string(getattr(app_settings, name))
+        except ImportError as exc:
+            errors.append(
+                Error(
+                    f"ALLAUTH_2FA_{name} can't be imported: {exc}",
+                    id="allauth_2fa.E006",
+                ),
+            )
+    return errors
@@ -1,15 +1,28 @@
 from __future__ import annotations
 
 import contextlib
+import time
 
 from django import forms
 from django.core.exceptions import ImproperlyConfigured
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.translation import gettext_lazy as _
 from django_otp.forms import OTPAuthenticationFormMixin
+from django_otp.oath import TOTP
+from django_otp.plugins.otp_static.models import StaticDevice
 from django_otp.plugins.otp_totp.models import TOTPDevice
 
 from allauth_2fa import app_settings
+from allauth_2fa.instrumentation import measure
+from allauth_2fa.ratelimit import get_rate_limiter
+from allauth_2fa.replay import get_replay_cache
+from allauth_2fa.replay import match_token
+from allauth_2fa.replay import verify_totp_device
+
+try:
+    from django_otp.forms import otp_verification_failed
+except ImportError:
+    otp_verification_failed = None
 
 DEFAULT_TOKEN_WIDGET_ATTRS = {
     "autofocus": "autofocus",
@@ -18,6 +31,15 @@ DEFAULT_TOKEN_WIDGET_ATTRS = {
 }
 
 
+def _token_field() -> forms.CharField:
+    # The widget is configured here, once per form class, rather than in the
+    # `__init__` of every form instance.
+    return forms.CharField(
+        label=_("Token"),
+        widget=forms.TextInput(attrs=DEFAULT_TOKEN_WIDGET_ATTRS),
+    )
+
+
 class _TokenToOTPTokenMixin:
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -35,42 +57,174 @@ class _TokenToOTPTokenMixin:
         )
 
 
-class TOTPAuthenticateForm(OTPAuthenticationFormMixin, forms.Form):
-    otp_token = forms.CharField(
-        label=_("Token"),
+class _RateLimitMixin:
+    rate_limit_error_message = _(
+        "Too many failed attempts. Please try again later.",
     )
 
-    def __init__(self, user, **kwargs):
+    def clean_otp_rate_limited(self, user) -> None:
+        """
+        Like `clean_otp`, but reject the attempt outright if there have been
+        too many failed ones, and count it if it fails.
+        """
+        rate_limiter = get_rate_limiter()
+        if not rate_limiter.enabled:
+            self.clean_otp(user)
+            return
+
+        keys = rate_limiter.get_keys(self.request, user)
+        if rate_limiter.is_limited(keys):
+            raise forms.ValidationError(
+                self.rate_limit_error_message,
+                code="rate_limited",
+            )
+        try:
+            self.clean_otp(user)
+        except forms.ValidationError:
+            rate_limiter.record_failure(keys)
+            raise
+
+
+class _ReplayCacheMixin:
+    def _verify_token(self, user, token, device=None):
+        """
+        Like `OTPAuthenticationFormMixin._verify_token`, but if the replay
+        cache is enabled, verify the TOTP devices with `verify_totp_device`,
+        as their saved `last_t` may not be up to date.
+        """
+        if get_replay_cache() is None:
+            return super()._verify_token(user, token, device)
+        if device is None:
+            device = match_token(user, token)
+        elif isinstance(device, TOTPDevice) and device.verify_is_allowed()[0]:
+            device = device if verify_totp_device(device, token) else None
+        else:
+            # Let django_otp verify other devices, and explain why a TOTP
+            # device can't be verified.
+            return super()._verify_token(user, token, device)
+        if device is None:
+            self._raise_invalid_token(user)
+        return device
+
+    def _raise_invalid_token(self, user):
+        if otp_verification_failed is not None:
+            otp_verification_failed.send(sender=self.__class__, user=user)
+        raise forms.ValidationError(
+            self.otp_error_messages["invalid_token"],
+            code="invalid_token",
+        )
+
+
+class TOTPAuthenticateForm(
+    _RateLimitMixin,
+    _ReplayCacheMixin,
+    OTPAuthenticationFormMixin,
+    forms.Form,
+):
+    otp_token = _token_field()
+
+    def __init__(self, user, device_ids=None, request=None, **kwargs):
         super().__init__(**kwargs)
-        self.fields["otp_token"].widget.attrs.update(DEFAULT_TOKEN_WIDGET_ATTRS)
         self.user = user
+        # The request, if known, for rate limiting by IP address and session.
+        self.request = request
+        # The devices to verify the token against, as returned by
+        # `allauth_2fa.utils.get_device_ids`. If None, all of the user's
+        # devices are tried.
+        self.device_ids = device_ids
 
     def clean(self) -> dict:
-        self.clean_otp(self.user)
+        with measure("authenticate.verify_token") as measurement:
+            self._throttled = False
+            try:
+                self.clean_otp_rate_limited(self.user)
+            except forms.ValidationError as exc:
+                measurement.outcome = (
+                    "throttled"
+                    if self._throttled
+                    else getattr(exc, "code", None) or "invalid"
+                )
+                raise
         return self.cleaned_data
 
+    def _verify_token(self, user, token, device=None):
+        if device is not None or self.device_ids is None:
+            return super()._verify_token(user, token, device)
+
+        device = self._match_device_ids(user, token)
+        if device is None:
+            self._raise_invalid_token(user)
+        return device
+
+    def _match_device_ids(self, user, token):
+        """
+        Like `django_otp.match_token`, but only looks up the devices in
+        `device_ids`, and the static devices only if no TOTP device matched.
+        """
+        for device_type, model, verify_token in (
+            ("totp", TOTPDevice, verify_totp_device),
+            ("static", StaticDevice, StaticDevice.verify_token),
+        ):
+            pks = self.device_ids.get(device_type)
+            if not pks:
+                continue
+            devices = model.objects.select_for_update().filter(
+                user=user,
+                confirmed=True,
+                pk__in=pks,
+            )
+            for device in devices:
+                if not device.verify_is_allowed()[0]:
+                    # The device would reject any token.
+                    self._throttled = True
+                elif verify_token(device, token):
+                    return device
+        return None
+
 
 class TOTPDeviceForm(_TokenToOTPTokenMixin, forms.Form):
-    otp_token = forms.CharField(
-        label=_("Token"),
-    )
+    otp_token = _token_field()
 
-    def __init__(self, user, metadata=None, **kwargs):
+    def __init__(self, user, metadata=None, device=None, **kwargs):
         super().__init__(**kwargs)
-        self.fields["otp_token"].widget.attrs.update(DEFAULT_TOKEN_WIDGET_ATTRS)
         self.user = user
         self.metadata = metadata or {}
+        # The unconfirmed device being set up. If None, it's looked up from
+        # the database; otherwise it may be an unsaved device.
+        self.device = device
 
     def clean_otp_token(self):
         token = self.cleaned_data.get("otp_token")
 
-        # Find the unconfirmed device and attempt to verify the token.
-        self.device = self.user.totpdevice_set.filter(confirmed=False).first()
-        if not self.device.verify_token(token):
+        if self.device is None:
+            # Find the unconfirmed device and attempt to verify the token.
+            self.device = self.user.totpdevice_set.filter(confirmed=False).first()
+            verified = self.device is not None and self.device.verify_token(token)
+        else:
+            verified = self._verify_setup_device_token(token)
+        if not verified:
             raise forms.ValidationError(_("The entered token is not valid"))
 
         return token
 
+    def _verify_setup_device_token(self, token) -> bool:
+        """
+        Like `TOTPDevice.verify_token`, but doesn't save the device (nor
+        throttle failed attempts, which would need saving it).
+        """
+        try:
+            token = int(token)
+        except ValueError:
+            return False
+        device = self.device
+        totp = TOTP(device.bin_key, device.step, device.t0, device.digits, device.drift)
+        totp.time = time.time()
+        if not totp.verify(token, device.tolerance):
+            return False
+        device.last_t = totp.t()
+        device.drift = totp.drift
+        return True
+
     def save(self) -> TOTPDevice:
         # The device was found to be valid, delete other confirmed devices and
         # confirm the new device.
@@ -83,23 +237,28 @@ class TOTPDeviceForm(_TokenToOTPTokenMixin, forms.Form):
 
 class TOTPDeviceRemoveForm(
     _TokenToOTPTokenMixin,
+    _RateLimitMixin,
+    _ReplayCacheMixin,
     OTPAuthenticationFormMixin,
     forms.Form,
 ):
-    def __init__(self, user, **kwargs):
+    otp_token = _token_field()
+
+    def __init__(self, user, request=None, **kwargs):
         super().__init__(**kwargs)
 
         self.user = user
+        # The request, if known, for rate limiting by IP address and session.
+        self.request = request
         # user has to enter OTP token to remove device
         # if REQUIRE_OTP_ON_DEVICE_REMOVAL is True
-        if app_settings.REQUIRE_OTP_ON_DEVICE_REMOVAL:
-            self.fields["otp_token"] = forms.CharField(label=_("Token"), required=True)
-            self.fields["otp_token"].widget.attrs.update(DEFAULT_TOKEN_WIDGET_ATTRS)
+        if not app_settings.REQUIRE_OTP_ON_DEVICE_REMOVAL:
+            del self.fields["otp_token"]
 
     def clean(self):
         # clean OTP token if REQUIRE_OTP_ON_DEVICE_REMOVAL is True
         if app_settings.REQUIRE_OTP_ON_DEVICE_REMOVAL:
-            self.clean_otp(self.user)
+            self.clean_otp_rate_limited(self.user)
         return self.cleaned_data
 
     def save(self) -> None:
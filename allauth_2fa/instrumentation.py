@@ -0,0 +1,158 @@
+"""
+Optional instrumentation of the 2FA hot paths.
+
+The operations wrapped in `measure()` report their duration, the number of
+database queries they ran and their outcome (e.g. "success" or
+"invalid_token") to the metrics backend configured with
+`ALLAUTH_2FA_METRICS_BACKEND`. By default, nothing is measured.
+"""
+
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterator
+
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from allauth_2fa import app_settings
+
+
+class NullMetricsBackend:
+    """The default backend, which doesn't measure anything."""
+
+    # If False, `measure()` doesn't bother timing or counting queries.
+    enabled = False
+
+    def record(
+        self,
+        name: str,
+        duration: float,
+        *,
+        queries: int,
+        outcome: str,
+    ) -> None:
+        """
+        Record a measurement of the operation `name`, which took `duration`
+        seconds and ran `queries` database queries.
+        """
+
+
+class HistogramMetricsBackend(NullMetricsBackend):
+    """
+    Keep histograms of the durations (and totals of the query counts) of each
+    operation and outcome in memory.
+
+    The backend instance can be retrieved with `get_metrics_backend()`, e.g.
+    to inspect it in tests or to export the histograms periodically.
+    """
+
+    enabled = True
+    # The upper bounds of the histogram buckets, in seconds.
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+            self._queries = defaultdict(int)
+
+    def record(
+        self,
+        name: str,
+        duration: float,
+        *,
+        queries: int,
+        outcome: str,
+    ) -> None:
+        bucket = bisect.bisect_left(self.buckets, duration)
+        with self._lock:
+            self._counts[name, outcome][bucket] += 1
+            self._queries[name, outcome] += queries
+
+    def histogram(self, name: str, outcome: str | None = None) -> list[int]:
+        """
+        Get the number of measurements of `name` in each duration bucket
+        (the last one counting those longer than the last bound).
+        """
+        totals = [0] * (len(self.buckets) + 1)
+        with self._lock:
+            for (key_name, key_outcome), counts in self._counts.items():
+                if key_name == name and outcome in (None, key_outcome):
+                    for bucket, count in enumerate(counts):
+                        totals[bucket] += count
+        return totals
+
+    def count(self, name: str, outcome: str | None = None) -> int:
+        """Get the number of measurements of `name` (with `outcome`)."""
+        return sum(self.histogram(name, outcome))
+
+    def queries(self, name: str, outcome: str | None = None) -> int:
+        """Get the total number of queries run by `name` (with `outcome`)."""
+        with self._lock:
+            return sum(
+                n_queries
+                for (key_name, key_outcome), n_queries in self._queries.items()
+                if key_name == name and outcome in (None, key_outcome)
+            )
+
+
+class Measurement:
+    def __init__(self) -> None:
+        # Set by the measured code; "success" if it's not set, or "error" if
+        # an exception is raised.
+        self.outcome: str | None = None
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Used as a database execute wrapper to count the queries.
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+@lru_cache(maxsize=None)
+def _load_metrics_backend(path: str) -> NullMetricsBackend:
+    return import_string(path)()
+
+
+def get_metrics_backend() -> NullMetricsBackend:
+    return _load_metrics_backend(app_settings.METRICS_BACKEND)
+
+
+@contextmanager
+def measure(name: str) -> Iterator[Measurement]:
+    """
+    Measure the operation in the block, and report it to the metrics backend.
+
+    Queries are counted on the default database connection of the current
+    thread.
+    """
+    measurement = Measurement()
+    backend = get_metrics_backend()
+    if not backend.enabled:
+        yield measurement
+        return
+
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(measurement):
+            yield measurement
+    except BaseException:
+        if measurement.outcome is None:
+            measurement.outcome = "error"
+        raise
+    finally:
+        backend.record(
+            name,
+            time.perf_counter() - start,
+            queries=measurement.queries,
+            outcome=measurement.outcome or "success",
+        )
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import time
+from datetime import timedelta
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db.models import Q
+from django.utils import timezone
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete unconfirmed TOTP devices left behind by abandoned 2FA setups. "
+        "Devices created before django-otp started recording creation times "
+        "are considered old."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-hours",
+            type=float,
+            default=24,
+            help="Only delete devices created more than this many hours ago.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of devices to delete per query.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help=(
+                "The number of seconds to sleep between batches, "
+                "e.g. to let replicas keep up."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Don't actually delete the devices.",
+        )
+
+    def handle(self, *, older_than_hours, batch_size, sleep, dry_run, **options):
+        try:
+            TOTPDevice._meta.get_field("created_at")
+        except FieldDoesNotExist as exc:
+            raise CommandError(
+                "This command requires a version of django-otp that records "
+                "the creation times of devices.",
+            ) from exc
+
+        cutoff = timezone.now() - timedelta(hours=older_than_hours)
+        devices = TOTPDevice.objects.filter(
+            Q(created_at__lt=cutoff) | Q(created_at__isnull=True),
+            confirmed=False,
+        )
+
+        n_deleted = 0
+        start_time = time.monotonic()
+        last_pk = None
+        while True:
+            batch = devices if last_pk is None else devices.filter(pk__gt=last_pk)
+            pks = list(batch.order_by("pk").values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            if dry_run:
+                n_deleted += len(pks)
+            else:
+                # Re-check the conditions in case a device was confirmed in
+                # the meantime.
+                deleted, _ = devices.filter(pk__in=pks).delete()
+                n_deleted += deleted
+            if options["verbosity"] >= 1:
+                rate = n_deleted / max(time.monotonic() - start_time, 1e-9)
+                self.stdout.write(
+                    f"Deleted {n_deleted} devices ({rate:.0f} rows/s); "
+                    f"last device ID: {last_pk}",
+                )
+            if sleep:
+                time.sleep(sleep)
+
+        verb = "Would have deleted" if dry_run else "Deleted"
+        self.stdout.write(f"{verb} {n_deleted} unconfirmed devices")
@@ -1,40 +1,214 @@
 from __future__ import annotations
 
 import base64
+import multiprocessing
+import time
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
+import django
 from allauth.mfa.adapter import get_adapter
 from allauth.mfa.models import Authenticator
 from django.core.management.base import BaseCommand
-from django_otp.plugins.otp_static.models import StaticDevice
+from django.db import transaction
+from django.db.models import Exists
+from django.db.models import OuterRef
+from django_otp.plugins.otp_static.models import StaticToken
 from django_otp.plugins.otp_totp.models import TOTPDevice
 
+MIGRATED_TYPES = [Authenticator.Type.TOTP, Authenticator.Type.RECOVERY_CODES]
 
-class Command(BaseCommand):
-    def handle(self, **options):
-        adapter = get_adapter()
-        authenticators = []
-        for totp in TOTPDevice.objects.filter(confirmed=True).iterator():
-            recovery_codes = set()
-            for sdevice in StaticDevice.objects.filter(
-                confirmed=True,
-                user_id=totp.user_id,
-            ).iterator():
-                recovery_codes.update(sdevice.token_set.values_list("token", flat=True))
-            secret = base64.b32encode(bytes.fromhex(totp.key)).decode("ascii")
-            totp_authenticator = Authenticator(
-                user_id=totp.user_id,
+
+def build_authenticators(adapter, user_ids: list) -> list[Authenticator]:
+    # A user is only supposed to have one confirmed TOTP device; should
+    # there be more, the latest one wins.
+    secrets = {}
+    for user_id, key in (
+        TOTPDevice.objects.filter(confirmed=True, user_id__in=user_ids)
+        .order_by("pk")
+        .values_list("user_id", "key")
+    ):
+        secrets[user_id] = base64.b32encode(bytes.fromhex(key)).decode("ascii")
+
+    recovery_codes = defaultdict(set)
+    for user_id, token in StaticToken.objects.filter(
+        device__confirmed=True,
+        device__user_id__in=user_ids,
+    ).values_list("device__user_id", "token"):
+        recovery_codes[user_id].add(token)
+
+    authenticators = []
+    for user_id in user_ids:
+        # The device may have been deleted since the user was selected.
+        if user_id not in secrets:
+            continue
+        authenticators.append(
+            Authenticator(
+                user_id=user_id,
                 type=Authenticator.Type.TOTP,
-                data={"secret": adapter.encrypt(secret)},
-            )
-            authenticators.append(totp_authenticator)
-            authenticators.append(
-                Authenticator(
-                    user_id=totp.user_id,
-                    type=Authenticator.Type.RECOVERY_CODES,
-                    data={
-                        "migrated_codes": [adapter.encrypt(c) for c in recovery_codes],
-                    },
+                data={"secret": adapter.encrypt(secrets[user_id])},
+            ),
+        )
+        authenticators.append(
+            Authenticator(
+                user_id=user_id,
+                type=Authenticator.Type.RECOVERY_CODES,
+                data={
+                    "migrated_codes": [
+                        adapter.encrypt(code)
+                        for code in sorted(recovery_codes[user_id])
+                    ],
+                },
+            ),
+        )
+    return authenticators
+
+
+def migrate_users(user_ids: list, dry_run: bool) -> int:
+    """
+    Create the Authenticators for the given users in a single transaction,
+    and return the number of Authenticators created (or that would have been
+    created, for a dry run).
+
+    This may be run in a worker process.
+    """
+    authenticators = build_authenticators(get_adapter(), user_ids)
+    if dry_run:
+        return len(authenticators)
+    existing = Authenticator.objects.filter(
+        user_id__in=user_ids,
+        type__in=MIGRATED_TYPES,
+    )
+    with transaction.atomic():
+        n_before = existing.count()
+        # Should another run have migrated some of these users in the
+        # meantime, leave their Authenticators be.
+        Authenticator.objects.bulk_create(authenticators, ignore_conflicts=True)
+        return existing.count() - n_before
+
+
+class Command(BaseCommand):
+    help = (
+        "Create allauth.mfa Authenticators for the users who have "
+        "allauth_2fa (django-otp) devices. Users who already have "
+        "Authenticators are skipped, so this can be run repeatedly."
+    )
+    executor_class = ProcessPoolExecutor
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of users to migrate per transaction.",
+        )
+        parser.add_argument(
+            "--start-after-user-id",
+            help=(
+                "Only migrate users with a greater ID than this; "
+                "used to resume an interrupted migration."
+            ),
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help=(
+                "The number of worker processes to build and create the "
+                "Authenticators in, one batch of users at a time."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Don't actually create the Authenticators.",
+        )
+
+    def handle(
+        self,
+        *,
+        batch_size,
+        start_after_user_id,
+        workers,
+        dry_run,
+        **options,
+    ):
+        n_users = n_authenticators = 0
+        start_time = time.monotonic()
+
+        for user_ids, n_created in self.migrate_batches(
+            self.iter_user_id_batches(start_after_user_id, batch_size),
+            workers=workers,
+            dry_run=dry_run,
+        ):
+            n_users += len(user_ids)
+            n_authenticators += n_created
+            rate = n_authenticators / max(time.monotonic() - start_time, 1e-9)
+            if options["verbosity"] >= 1:
+                self.stdout.write(
+                    f"Migrated {n_users} users ({n_authenticators} Authenticators, "
+                    f"{rate:.0f} rows/s); last user ID: {user_ids[-1]}",
+                )
+
+        verb = "Would have created" if dry_run else "Created"
+        self.stdout.write(f"{verb} {n_authenticators} Authenticators")
+
+    def migrate_batches(self, batches, *, workers: int, dry_run: bool):
+        """
+        Migrate the batches of user IDs, yielding each batch and the number of
+        Authenticators created for it, in order.
+        """
+        if workers <= 1:
+            for user_ids in batches:
+                yield user_ids, migrate_users(user_ids, dry_run)
+            return
+
+        # Spawn the workers instead of forking them, so they don't inherit the
+        # database connections this process opens to find the batches (the
+        # workers are started lazily, so closing them beforehand isn't enough).
+        with self.executor_class(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        ) as executor:
+            pending = deque()
+            for user_ids in batches:
+                pending.append(
+                    (user_ids, executor.submit(migrate_users, user_ids, dry_run)),
+                )
+                # Don't queue up more batches than the workers can handle.
+                if len(pending) >= workers * 2:
+                    user_ids, future = pending.popleft()
+                    yield user_ids, future.result()
+            for user_ids, future in pending:
+                yield user_ids, future.result()
+
+    def iter_user_id_batches(self, last_user_id, batch_size: int):
+        while True:
+            user_ids = self.get_user_ids(last_user_id, batch_size)
+            if not user_ids:
+                return
+            yield user_ids
+            last_user_id = user_ids[-1]
+
+    def get_user_ids(self, last_user_id, batch_size: int) -> list:
+        """
+        Get the IDs of the next `batch_size` users with confirmed TOTP devices
+        who haven't been migrated yet, in order.
+        """
+        devices = TOTPDevice.objects.filter(confirmed=True).exclude(
+            Exists(
+                Authenticator.objects.filter(
+                    user_id=OuterRef("user_id"),
+                    type__in=MIGRATED_TYPES,
                 ),
-            )
-        Authenticator.objects.bulk_create(authenticators)
-        self.stdout.write(f"Created {len(authenticators)} Authenticators")
+            ),
+        )
+        if last_user_id is not None:
+            devices = devices.filter(user_id__gt=last_user_id)
+        return list(
+            devices.order_by("user_id")
+            .values_list("user_id", flat=True)
+            .distinct()[:batch_size],
+        )
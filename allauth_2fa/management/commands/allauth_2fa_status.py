@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+from allauth_2fa.models import TwoFactorStatus
+from allauth_2fa.utils import upsert_2fa_statuses
+
+
+class Command(BaseCommand):
+    help = (
+        "Verify the TwoFactorStatus table (see ALLAUTH_2FA_STATUS_TABLE) against "
+        "the TOTP devices, and with --rebuild, fix the statuses that don't match "
+        "and record those of the users who don't have one. "
+        "Exits with an error if statuses don't match and --rebuild isn't given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help=(
+                "Fix the statuses that don't match the devices, and record the "
+                "missing ones."
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of statuses to fix per query.",
+        )
+
+    def handle(self, *, rebuild, batch_size, **options):
+        enabled = set(
+            TOTPDevice.objects.filter(confirmed=True)
+            .values_list("user_id", flat=True)
+            .distinct(),
+        )
+        recorded = set(
+            TwoFactorStatus.objects.filter(has_2fa=True).values_list(
+                "user_id",
+                flat=True,
+            ),
+        )
+        unrecorded = set(
+            get_user_model()
+            .objects.filter(allauth_2fa_status__isnull=True)
+            .values_list("pk", flat=True),
+        )
+        # Users whose status is missing, or false while they have 2FA, and
+        # users whose status is true without 2FA.
+        missing = sorted((enabled - recorded) | unrecorded)
+        extra = sorted(recorded - enabled)
+        if options["verbosity"] >= 1:
+            self.stdout.write(
+                f"{len(enabled)} users have 2FA enabled; "
+                f"{len(missing) + len(extra)} statuses don't match",
+            )
+        if not missing and not extra:
+            return
+        if not rebuild:
+            raise CommandError(
+                f"{len(missing) + len(extra)} statuses don't match the devices; "
+                f"run with --rebuild to fix them.",
+            )
+
+        n_fixed = 0
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i : i + batch_size]
+            # Re-check, in case the devices changed in the meantime.
+            user_ids = set(
+                TOTPDevice.objects.filter(user_id__in=batch, confirmed=True)
+                .values_list("user_id", flat=True)
+                .distinct(),
+            )
+            upsert_2fa_statuses({pk: pk in user_ids for pk in batch})
+            n_fixed += len(batch)
+        for i in range(0, len(extra), batch_size):
+            batch = extra[i : i + batch_size]
+            n_fixed += (
+                TwoFactorStatus.objects.filter(pk__in=batch)
+                .exclude(user__totpdevice__confirmed=True)
+                .update(has_2fa=False)
+            )
+        if options["verbosity"] >= 1:
+            self.stdout.write(f"Fixed {n_fixed} statuses")
@@ -1,14 +1,72 @@
 from __future__ import annotations
 
+import re
+from functools import lru_cache
+
 from allauth.account.adapter import get_adapter
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.http import HttpRequest
 from django.http import HttpResponse
 from django.shortcuts import redirect
+from django.urls import NoReverseMatch
+from django.urls import Resolver404
+from django.urls import URLResolver
+from django.urls import get_resolver
+from django.urls import get_urlconf
 from django.urls import resolve
 from django.utils.deprecation import MiddlewareMixin
 
+from allauth_2fa.instrumentation import measure
+from allauth_2fa.utils import SATISFIED_SESSION_KEY
+from allauth_2fa.utils import aget_device_generation
+from allauth_2fa.utils import aget_user
+from allauth_2fa.utils import aload_session
+from allauth_2fa.utils import clear_pending_login
+from allauth_2fa.utils import get_2fa_satisfied_marker
+from allauth_2fa.utils import get_device_generation
+from allauth_2fa.utils import get_status_cache
+
+try:
+    from asgiref.sync import iscoroutinefunction
+except ImportError:
+    from asyncio import iscoroutinefunction
+
+AUTHENTICATE_URL_NAME_PREFIX = "two-factor-authenticate"
+# The session key of the flag set while the "2FA required" message is pending.
+REQUIRE_2FA_MESSAGE_SESSION_KEY = "allauth_2fa_require_2fa_message"
+
+
+def get_authenticate_paths(urlconf: str) -> frozenset[str]:
+    """
+    Get the paths of the URLs whose names start with "two-factor-authenticate"
+    (and that don't take any arguments) in the given URLconf.
+    """
+    # `get_resolver` is cached too, and returns a new resolver once the URL
+    # caches have been cleared (e.g. by `clear_url_caches`).
+    return _get_authenticate_paths(get_resolver(urlconf))
+
+
+@lru_cache(maxsize=16)
+def _get_authenticate_paths(resolver: URLResolver) -> frozenset[str]:
+    paths = set()
+    for name in resolver.reverse_dict:
+        if isinstance(name, str) and name.startswith(AUTHENTICATE_URL_NAME_PREFIX):
+            try:
+                paths.add(f"/{resolver.reverse(name)}")
+            except NoReverseMatch:
+                pass
+    return frozenset(paths)
+
+
+@receiver(setting_changed)
+def _clear_authenticate_paths(*, setting: str, **kwargs) -> None:
+    if setting == "ROOT_URLCONF":
+        _get_authenticate_paths.cache_clear()
+
 
 class AllauthTwoFactorMiddleware(MiddlewareMixin):
     """
@@ -17,17 +75,71 @@ class AllauthTwoFactorMiddleware(MiddlewareMixin):
     entered their two-factor credentials.) This makes sure a user does not stay
     half logged in by mistake.
 
+    This middleware can run natively in both sync and async mode.
     """
 
     def process_request(self, request: HttpRequest) -> None:
-        match = resolve(request.path)
-        if not match.url_name or not match.url_name.startswith(
-            "two-factor-authenticate",
-        ):
-            try:
-                del request.session["allauth_2fa_user_id"]
-            except KeyError:
-                pass
+        # Without a session cookie, there can't be a pending login; don't
+        # bother loading the session at all.
+        if settings.SESSION_COOKIE_NAME in request.COOKIES:
+            self.reset_pending_login(request)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        response = None
+        if type(self).process_request is AllauthTwoFactorMiddleware.process_request:
+            # Only the session needs to be loaded without blocking; the rest
+            # of `process_request` doesn't do any I/O, unless a pending login
+            # cache entry may need to be deleted.
+            if settings.SESSION_COOKIE_NAME in request.COOKIES:
+                await aload_session(request.session)
+                if "allauth_2fa_login_key" in request.session:
+                    await sync_to_async(
+                        self.reset_pending_login,
+                        thread_sensitive=True,
+                    )(request)
+                else:
+                    self.reset_pending_login(request)
+        else:
+            # Run an overridden `process_request` like `MiddlewareMixin` does.
+            response = await sync_to_async(
+                self.process_request,
+                thread_sensitive=True,
+            )(request)
+        response = response or await self.get_response(request)
+        if hasattr(self, "process_response"):
+            response = await sync_to_async(
+                self.process_response,
+                thread_sensitive=True,
+            )(request, response)
+        return response
+
+    def reset_pending_login(self, request: HttpRequest) -> None:
+        if "allauth_2fa_user_id" not in request.session:
+            return
+        with measure("reset_pending_login_middleware") as measurement:
+            if self.is_authenticate_page(request):
+                measurement.outcome = "kept"
+            else:
+                measurement.outcome = "reset"
+                clear_pending_login(request.session)
+
+    def is_authenticate_page(self, request: HttpRequest) -> bool:
+        """
+        Check whether the request is for one of the pages that are part of
+        entering the two-factor credentials.
+        """
+        urlconf = (
+            getattr(request, "urlconf", None) or get_urlconf() or settings.ROOT_URLCONF
+        )
+        if request.path_info in get_authenticate_paths(urlconf):
+            return True
+        try:
+            match = resolve(request.path_info, urlconf)
+        except Resolver404:
+            return False
+        return bool(
+            match.url_name and match.url_name.startswith(AUTHENTICATE_URL_NAME_PREFIX),
+        )
 
 
 class BaseRequire2FAMiddleware(MiddlewareMixin):
@@ -37,9 +149,20 @@ class BaseRequire2FAMiddleware(MiddlewareMixin):
 
     If they don't have 2FA enabled, they will be redirected to the 2FA
     enrollment page and not be allowed to access other pages.
+
+    When running in async mode, `aprocess_view` is used instead of
+    `process_view`; override `arequire_2fa` to avoid running `require_2fa`
+    in a thread.
+
+    Once a user is found to have 2FA enabled, this is recorded in the session,
+    so neither `require_2fa` nor the 2FA status lookup are needed on later
+    requests. The record is invalidated when the session's auth hash changes
+    or (if `ALLAUTH_2FA_STATUS_CACHE` is set) when a device of the user is
+    removed.
     """
 
-    # List of URL names that the user should still be allowed to access.
+    # List of URL names (or namespaced view names, e.g. "admin:logout") that
+    # the user should still be allowed to access.
     allowed_pages = [
         # They should still be able to log out or change password.
         "account_change_password",
@@ -47,12 +170,46 @@ class BaseRequire2FAMiddleware(MiddlewareMixin):
         "account_reset_password",
         # URLs required to set up two-factor
         "two-factor-setup",
+        "two-factor-setup-qr",
     ]
+    # URL namespaces whose pages the user should still be allowed to access.
+    allowed_namespaces = []
+    # Path prefixes (e.g. "/static/" or "/health/") and regular expressions
+    # (matched at the start of the path) of pages the user should still be
+    # allowed to access, even if their URLs can't be resolved.
+    allowed_path_prefixes = []
+    allowed_path_patterns = []
     # The message to the user if they don't have 2FA enabled and must enable it.
     require_2fa_message = (
         "You must enable two-factor authentication before doing anything else."
     )
 
+    def __init__(self, get_response) -> None:
+        super().__init__(get_response)
+        if (
+            iscoroutinefunction(self.get_response)
+            and type(self).process_view is BaseRequire2FAMiddleware.process_view
+        ):
+            # Django adapts process_view to the mode of the handler; hand it
+            # the native async version so it won't be run in a thread.
+            self.process_view = self.aprocess_view
+        self.compile_allowed_pages()
+
+    def compile_allowed_pages(self) -> None:
+        """
+        Compile the allow-list attributes into sets and a single regular
+        expression, so checking a request against them is cheap.
+        """
+        self._allowed_view_names = frozenset(self.allowed_pages)
+        self._allowed_namespaces = frozenset(self.allowed_namespaces)
+        path_patterns = [
+            *(re.escape(prefix) for prefix in self.allowed_path_prefixes),
+            *(f"(?:{pattern})" for pattern in self.allowed_path_patterns),
+        ]
+        self._allowed_path_re = (
+            re.compile("|".join(path_patterns)) if path_patterns else None
+        )
+
     def on_require_2fa(self, request: HttpRequest) -> HttpResponse:
         """
         If the current request requires 2FA and the user does not have it
@@ -61,19 +218,17 @@ class BaseRequire2FAMiddleware(MiddlewareMixin):
         """
         # See allauth.account.adapter.DefaultAccountAdapter.add_message.
         if "django.contrib.messages" in settings.INSTALLED_APPS:
-            # If there is already a pending message related to two-factor (likely
-            # created by a redirect view), simply update the message text.
-            storage = messages.get_messages(request)
-            tag = "2fa_required"
-            for m in storage:
-                if m.extra_tags == tag:
-                    m.message = self.require_2fa_message
-                    break
-            # Otherwise, create a new message.
-            else:
-                messages.error(request, self.require_2fa_message, extra_tags=tag)
-            # Mark the storage as not processed so they'll be shown to the user.
-            storage.used = False
+            # Unless the message is already pending (i.e. the user hasn't seen
+            # the setup page since it was added), add it. The session flag
+            # avoids loading (and storing again) all the pending messages to
+            # find out.
+            if not request.session.get(REQUIRE_2FA_MESSAGE_SESSION_KEY):
+                messages.error(
+                    request,
+                    self.require_2fa_message,
+                    extra_tags="2fa_required",
+                )
+                request.session[REQUIRE_2FA_MESSAGE_SESSION_KEY] = True
 
         # Redirect user to two-factor setup page.
         return redirect("two-factor-setup")
@@ -89,8 +244,39 @@ class BaseRequire2FAMiddleware(MiddlewareMixin):
         """
         raise NotImplementedError("You must implement require_2fa.")
 
+    async def arequire_2fa(self, request: HttpRequest) -> bool:
+        """
+        Async version of `require_2fa`.
+
+        By default, this runs `require_2fa` in a thread. Override this to
+        avoid the thread switch; use `await request.auser()` instead of
+        `request.user` to access the user.
+        """
+        return await sync_to_async(self.require_2fa)(request)
+
     def is_allowed_page(self, request: HttpRequest) -> bool:
-        return request.resolver_match.url_name in self.allowed_pages
+        """
+        Check whether the request is for a page on the allow-list, which the
+        user may access even if they haven't set up 2FA.
+        """
+        if self._allowed_path_re and self._allowed_path_re.match(request.path_info):
+            return True
+        match = request.resolver_match
+        if match is None:
+            return False
+        if match.url_name in self._allowed_view_names:
+            return True
+        if match.namespaces and (
+            match.view_name in self._allowed_view_names
+            or match.namespace in self._allowed_namespaces
+            or not self._allowed_namespaces.isdisjoint(match.namespaces)
+        ):
+            return True
+        return False
+
+    def is_setup_page(self, request: HttpRequest) -> bool:
+        match = request.resolver_match
+        return match is not None and match.url_name == "two-factor-setup"
 
     def process_view(
         self,
@@ -99,21 +285,104 @@ class BaseRequire2FAMiddleware(MiddlewareMixin):
         view_args,
         view_kwargs,
     ) -> HttpResponse | None:
-        # The user is not logged in, do nothing.
-        if request.user.is_anonymous:
-            return None
+        with measure("require_2fa_middleware") as measurement:
+            # If the user is on one of the allowed pages, do nothing. This is
+            # checked first, as it needs neither the user nor the database.
+            if self.is_allowed_page(request):
+                measurement.outcome = "allowed_page"
+                if self.is_setup_page(request):
+                    # The pending message is shown on the setup page.
+                    request.session.pop(REQUIRE_2FA_MESSAGE_SESSION_KEY, None)
+                return None
+
+            # The user is not logged in, do nothing.
+            if request.user.is_anonymous:
+                measurement.outcome = "anonymous"
+                return None
+
+            # The user has already been found to have 2FA enabled. The marker
+            # is only used with the status cache, as removing a device is only
+            # noticed through the device generation kept there.
+            use_marker = get_status_cache() is not None
+            marker = request.session.get(SATISFIED_SESSION_KEY) if use_marker else None
+            if marker is not None and marker == get_2fa_satisfied_marker(
+                request,
+                get_device_generation(request.user.pk),
+            ):
+                measurement.outcome = "2fa_satisfied"
+                return None
+
+            # If this doesn't require 2FA, then stop processing.
+            if not self.require_2fa(request):
+                measurement.outcome = "not_required"
+                return None
+
+            # User already has two-factor configured, do nothing.
+            if get_adapter(request).has_2fa_enabled(request.user):
+                measurement.outcome = "2fa_enabled"
+                if use_marker:
+                    request.session[SATISFIED_SESSION_KEY] = get_2fa_satisfied_marker(
+                        request,
+                        get_device_generation(request.user.pk, create=True),
+                    )
+                return None
+
+            # The request required 2FA but it isn't configured!
+            measurement.outcome = "redirected"
+            return self.on_require_2fa(request)
+
+    async def aprocess_view(
+        self,
+        request: HttpRequest,
+        view_func,
+        view_args,
+        view_kwargs,
+    ) -> HttpResponse | None:
+        """Async version of `process_view`."""
+        with measure("require_2fa_middleware") as measurement:
+            # If the user is on one of the allowed pages, do nothing. This is
+            # checked first, as it needs neither the user nor the database.
+            if self.is_allowed_page(request):
+                measurement.outcome = "allowed_page"
+                if self.is_setup_page(request):
+                    # The pending message is shown on the setup page.
+                    await aload_session(request.session)
+                    request.session.pop(REQUIRE_2FA_MESSAGE_SESSION_KEY, None)
+                return None
+
+            user = await aget_user(request)
+            # The user is not logged in, do nothing.
+            if user.is_anonymous:
+                measurement.outcome = "anonymous"
+                return None
 
-        # If this doesn't require 2FA, then stop processing.
-        if not self.require_2fa(request):
-            return None
+            # The user has already been found to have 2FA enabled. The marker
+            # is only used with the status cache, as removing a device is only
+            # noticed through the device generation kept there.
+            use_marker = get_status_cache() is not None
+            marker = request.session.get(SATISFIED_SESSION_KEY) if use_marker else None
+            if marker is not None and marker == get_2fa_satisfied_marker(
+                request,
+                await aget_device_generation(user.pk),
+            ):
+                measurement.outcome = "2fa_satisfied"
+                return None
 
-        # If the user is on one of the allowed pages, do nothing.
-        if self.is_allowed_page(request):
-            return None
+            # If this doesn't require 2FA, then stop processing.
+            if not await self.arequire_2fa(request):
+                measurement.outcome = "not_required"
+                return None
 
-        # User already has two-factor configured, do nothing.
-        if get_adapter(request).has_2fa_enabled(request.user):
-            return None
+            # User already has two-factor configured, do nothing.
+            if await get_adapter(request).ahas_2fa_enabled(user):
+                measurement.outcome = "2fa_enabled"
+                if use_marker:
+                    request.session[SATISFIED_SESSION_KEY] = get_2fa_satisfied_marker(
+                        request,
+                        await aget_device_generation(user.pk, create=True),
+                    )
+                return None
 
-        # The request required 2FA but it isn't configured!
-        return self.on_require_2fa(request)
+            # The request required 2FA but it isn't configured!
+            measurement.outcome = "redirected"
+            return self.on_require_2fa(request)
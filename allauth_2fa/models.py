@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+from django.conf import settings
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class TwoFactorStatus(models.Model):
+    """
+    Whether a user has 2FA enabled (i.e. a confirmed TOTP device), kept up to
+    date with the devices if `ALLAUTH_2FA_STATUS_TABLE` is enabled, so it can
+    be looked up by primary key.
+
+    Every user is supposed to have a row: one is created along with the user,
+    and `allauth_2fa_status --rebuild` creates them for existing users. A
+    missing row means the status isn't recorded yet; it's then looked up from
+    the devices, and recorded.
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="allauth_2fa_status",
+    )
+    has_2fa = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("two-factor authentication status")
+        verbose_name_plural = _("two-factor authentication statuses")
+
+    def __str__(self) -> str:
+        return f"{self.user_id}: {'enabled' if self.has_2fa else 'disabled'}"
@@ -0,0 +1,171 @@
+"""
+Optional rate limiting of the 2FA token verification.
+
+Failed verifications are counted per user, per IP address and per session
+(i.e. per pending login) in a sliding window by the rate limiter configured
+with `ALLAUTH_2FA_RATE_LIMITER`. Once any of these counts reaches
+`ALLAUTH_2FA_RATE_LIMIT_ATTEMPTS`, further attempts are rejected before the
+devices are even loaded, so they don't cause any database writes (e.g. by
+django_otp's per-device throttling). By default, nothing is rate limited.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import defaultdict
+from collections import deque
+from functools import lru_cache
+
+from django.core.cache import caches
+from django.http import HttpRequest
+from django.utils.module_loading import import_string
+
+from allauth_2fa import app_settings
+
+
+class NullRateLimiter:
+    """The default rate limiter, which doesn't limit anything."""
+
+    # If False, the keys aren't even computed.
+    enabled = False
+
+    def get_keys(self, request: HttpRequest | None, user) -> list[str]:
+        """
+        Get the keys to count the failed attempts of `user` under: the user,
+        and (if known) the client's IP address and the session.
+
+        Override this to e.g. use the client's IP address from a header set by
+        a reverse proxy.
+        """
+        keys = [f"user:{user.pk}"]
+        if request is not None:
+            ip_address = request.META.get("REMOTE_ADDR")
+            if ip_address:
+                keys.append(f"ip:{ip_address}")
+            session = getattr(request, "session", None)
+            if session is not None and session.session_key:
+                keys.append(f"session:{session.session_key}")
+        return keys
+
+    def is_limited(self, keys: list[str]) -> bool:
+        """Check whether the attempts for any of `keys` are over the limit."""
+        return False
+
+    def record_failure(self, keys: list[str]) -> None:
+        """Count a failed attempt for each of `keys`."""
+
+
+class LocalRateLimiter(NullRateLimiter):
+    """
+    Count the failed attempts in the memory of the current process, with an
+    exact sliding window.
+
+    The counts aren't shared between processes, so the effective limit is
+    multiplied by the number of processes serving the site. The keys that
+    haven't failed within the window are dropped once per window, so only
+    the recently failing ones are kept in memory.
+    """
+
+    enabled = True
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._failures: dict[str, deque[float]] = defaultdict(deque)
+        self._next_sweep = 0.0
+
+    def _prune(self, key: str, now: float) -> deque[float] | None:
+        failures = self._failures.get(key)
+        if failures is None:
+            return None
+        cutoff = now - app_settings.RATE_LIMIT_WINDOW
+        while failures and failures[0] <= cutoff:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return None
+        return failures
+
+    def _sweep(self, now: float) -> None:
+        if now < self._next_sweep:
+            return
+        for key in list(self._failures):
+            self._prune(key, now)
+        self._next_sweep = now + app_settings.RATE_LIMIT_WINDOW
+
+    def is_limited(self, keys: list[str]) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                failures = self._prune(key, now)
+                if failures and len(failures) >= app_settings.RATE_LIMIT_ATTEMPTS:
+                    return True
+        return False
+
+    def record_failure(self, keys: list[str]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            for key in keys:
+                self._prune(key, now)
+                self._failures[key].append(now)
+
+
+class CacheRateLimiter(NullRateLimiter):
+    """
+    Count the failed attempts in the `ALLAUTH_2FA_RATE_LIMIT_CACHE` cache,
+    which should be shared between the processes serving the site.
+
+    The sliding window is approximated from the counts of the current and
+    the previous fixed windows, weighting the latter by how much of it still
+    overlaps the sliding window. Checking the keys is a single cache call.
+    """
+
+    enabled = True
+
+    def _get_cache_keys(self, key: str, now: float) -> tuple[str, str, float]:
+        window = app_settings.RATE_LIMIT_WINDOW
+        current, elapsed = divmod(now, window)
+        return (
+            f"allauth_2fa:ratelimit:{key}:{int(current)}",
+            f"allauth_2fa:ratelimit:{key}:{int(current) - 1}",
+            1 - elapsed / window,
+        )
+
+    def is_limited(self, keys: list[str]) -> bool:
+        now = time.time()
+        cache_keys = [self._get_cache_keys(key, now) for key in keys]
+        counts = caches[app_settings.RATE_LIMIT_CACHE].get_many(
+            [
+                cache_key
+                for current, previous, _ in cache_keys
+                for cache_key in (current, previous)
+            ],
+        )
+        for current, previous, previous_weight in cache_keys:
+            count = counts.get(current, 0) + counts.get(previous, 0) * previous_weight
+            if count >= app_settings.RATE_LIMIT_ATTEMPTS:
+                return True
+        return False
+
+    def record_failure(self, keys: list[str]) -> None:
+        cache = caches[app_settings.RATE_LIMIT_CACHE]
+        now = time.time()
+        for key in keys:
+            current, _, _ = self._get_cache_keys(key, now)
+            # Keep the count for as long as it may be the previous window.
+            if not cache.add(current, 1, app_settings.RATE_LIMIT_WINDOW * 2):
+                try:
+                    cache.incr(current)
+                except ValueError:
+                    # The key expired in between.
+                    cache.add(current, 1, app_settings.RATE_LIMIT_WINDOW * 2)
+
+
+@lru_cache(maxsize=None)
+def _load_rate_limiter(path: str) -> NullRateLimiter:
+    return import_string(path)()
+
+
+def get_rate_limiter() -> NullRateLimiter:
+    return _load_rate_limiter(app_settings.RATE_LIMITER)
@@ -0,0 +1,173 @@
+"""
+Optional replay protection of TOTP tokens in a cache, so successful logins
+don't have to save the device.
+
+`TOTPDevice.verify_token` saves the device after every successful
+verification, to remember the last used time step (`last_t`) and so reject
+replays of the same token. With `ALLAUTH_2FA_TOTP_REPLAY_CACHE` set, the time
+steps used on each device are remembered in that cache instead, for as long as
+their tokens are valid. The new `last_t`, `drift` and `last_used_at` of the
+devices are written later, in batches.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import BaseCache
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import F
+from django.db.models import Value
+from django.db.models import When
+from django_otp import devices_for_user
+from django_otp.models import Device
+from django_otp.oath import TOTP
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+from allauth_2fa import app_settings
+
+_lock = threading.Lock()
+# The `last_t`, `drift` and `last_used_at` of the devices that are yet to be
+# saved, keyed by primary key.
+_pending_usage: dict[int, tuple] = {}
+_last_flush = time.monotonic()
+
+
+def get_replay_cache() -> BaseCache | None:
+    """
+    Get the cache used to remember the used TOTP time steps, or None if the
+    devices are saved on every verification.
+    """
+    alias = app_settings.TOTP_REPLAY_CACHE
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def get_replay_cache_key(device: TOTPDevice, t: int) -> str:
+    return f"allauth_2fa:totp_used:{device.pk}:{t}"
+
+
+def verify_totp_device(device: TOTPDevice, token) -> bool:
+    """
+    Like `TOTPDevice.verify_token`, but if the replay cache is enabled,
+    a successful verification doesn't save the device (unless its throttling
+    needs to be reset).
+    """
+    cache = get_replay_cache()
+    if cache is None:
+        return device.verify_token(token)
+
+    if not device.verify_is_allowed()[0]:
+        return False
+    try:
+        token = int(token)
+    except ValueError:
+        verified = False
+    else:
+        totp = TOTP(device.bin_key, device.step, device.t0, device.digits, device.drift)
+        totp.time = time.time()
+        verified = totp.verify(token, device.tolerance, device.last_t + 1)
+        # The token is valid for (at most) this long; `add` is atomic, so
+        # only one of concurrent attempts with the same token succeeds.
+        verified = verified and cache.add(
+            get_replay_cache_key(device, totp.t()),
+            True,
+            device.step * (2 * device.tolerance + 2),
+        )
+    if not verified:
+        device.throttle_increment(commit=True)
+        return False
+
+    device.last_t = totp.t()
+    if getattr(settings, "OTP_TOTP_SYNC", True):
+        device.drift = totp.drift
+    device.set_last_used_timestamp(commit=False)
+    if device.throttling_failure_count:
+        device.throttle_reset(commit=True)
+    record_device_usage(device)
+    return True
+
+
+def match_token(user, token) -> Device | None:
+    """
+    Like `django_otp.match_token`, but verifies the TOTP devices with
+    `verify_totp_device`.
+    """
+    with transaction.atomic():
+        for device in devices_for_user(user, for_verify=True):
+            if isinstance(device, TOTPDevice):
+                verified = verify_totp_device(device, token)
+            else:
+                verified = device.verify_token(token)
+            if verified:
+                return device
+    return None
+
+
+def record_device_usage(device: TOTPDevice) -> None:
+    """
+    Remember to save the `last_t`, `drift` and `last_used_at` of the device,
+    and save them (along with those of the other devices used in the
+    meantime) if it's time to.
+    """
+    usage = (device.last_t, device.drift, device.last_used_at)
+    with _lock:
+        pending = _pending_usage.get(device.pk)
+        if pending is None or pending[0] < usage[0]:
+            _pending_usage[device.pk] = usage
+        due = (
+            len(_pending_usage) >= app_settings.TOTP_USAGE_FLUSH_BATCH_SIZE
+            or time.monotonic() - _last_flush >= app_settings.TOTP_USAGE_FLUSH_INTERVAL
+        )
+    if due:
+        flush_device_usage()
+
+
+def flush_device_usage() -> int:
+    """
+    Save the `last_t`, `drift` and `last_used_at` of the devices used since
+    the last flush in a single query. Returns the number of devices saved.
+
+    A device is only updated if its saved `last_t` is older, so a newer time
+    step saved in the meantime (e.g. by `TOTPDevice.verify_token`) isn't
+    overwritten.
+
+    This is called automatically, but only by a verification once it's due;
+    call it e.g. periodically or before shutting down the process to not
+    lose any updates.
+    """
+    global _last_flush
+    with _lock:
+        pending = dict(_pending_usage)
+        _pending_usage.clear()
+        _last_flush = time.monotonic()
+    if not pending:
+        return 0
+    devices = [
+        TOTPDevice(
+            pk=pk,
+            last_t=_if_newer(last_t, last_t, "last_t"),
+            drift=_if_newer(last_t, drift, "drift"),
+            last_used_at=_if_newer(last_t, last_used_at, "last_used_at"),
+        )
+        for pk, (last_t, drift, last_used_at) in pending.items()
+    ]
+    return TOTPDevice.objects.bulk_update(
+        devices,
+        ["last_t", "drift", "last_used_at"],
+    )
+
+
+def _if_newer(last_t: int, value, field_name: str) -> Case:
+    # The value to save, if `last_t` is newer than the saved one.
+    field = TOTPDevice._meta.get_field(field_name)
+    return Case(
+        When(last_t__lt=last_t, then=Value(value, output_field=field)),
+        default=F(field_name),
+        output_field=field,
+    )
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_init
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+from allauth_2fa import app_settings
+from allauth_2fa.models import TwoFactorStatus
+from allauth_2fa.utils import forget_totp_device_status
+from allauth_2fa.utils import update_status_table
+
+# Attribute used to remember whether a device was confirmed when it was loaded
+# (or last saved), to tell whether saving it changes the user's 2FA status.
+_LOADED_CONFIRMED_ATTR = "_allauth_2fa_loaded_confirmed"
+
+
+def _get_cached_user(device: TOTPDevice):
+    # Only touch the user instance if it has already been loaded; there's no
+    # point in fetching it from the database just to forget its status.
+    if TOTPDevice.user.is_cached(device):
+        return device.user
+    return None
+
+
+@receiver(post_init, sender=TOTPDevice)
+def remember_loaded_confirmed(sender, instance: TOTPDevice, **kwargs) -> None:
+    # Read the field from `__dict__`, so a deferred field isn't loaded.
+    instance.__dict__[_LOADED_CONFIRMED_ATTR] = instance.__dict__.get("confirmed")
+
+
+@receiver(post_save, sender=TOTPDevice)
+def update_status_on_device_save(
+    sender,
+    instance: TOTPDevice,
+    created: bool,
+    update_fields=None,
+    **kwargs,
+) -> None:
+    # Most saves (e.g. django_otp recording the last used token, or throttling
+    # failed attempts) don't change whether the device is confirmed, and a new
+    # unconfirmed device doesn't change anything either.
+    if update_fields is not None and "confirmed" not in update_fields:
+        changed = False
+    elif created:
+        changed = instance.confirmed
+    else:
+        was_confirmed = instance.__dict__.get(_LOADED_CONFIRMED_ATTR)
+        changed = was_confirmed is None or was_confirmed != instance.confirmed
+    if update_fields is None or "confirmed" in update_fields:
+        instance.__dict__[_LOADED_CONFIRMED_ATTR] = instance.confirmed
+
+    if not changed:
+        return
+
+    forget_totp_device_status(
+        instance.user_id,
+        user=_get_cached_user(instance),
+        using=kwargs["using"],
+    )
+    if app_settings.STATUS_TABLE:
+        update_status_table(instance.user_id, True if instance.confirmed else None)
+
+
+@receiver(post_delete, sender=TOTPDevice)
+def update_status_on_device_delete(sender, instance: TOTPDevice, **kwargs) -> None:
+    # Removing an unconfirmed device doesn't change anything. (If the field
+    # wasn't loaded, assume the device was confirmed.)
+    if not instance.__dict__.get("confirmed", True):
+        return
+    forget_totp_device_status(
+        instance.user_id,
+        user=_get_cached_user(instance),
+        using=kwargs["using"],
+    )
+    if app_settings.STATUS_TABLE:
+        # The device may be deleted along with its user; don't recreate the
+        # row the deletion of the user may already have removed. (A missing
+        # row is looked up from the devices anyway.)
+        update_status_table(instance.user_id, create=False)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def create_status_on_user_create(sender, instance, created, raw=False, **kwargs):
+    # Record the status of new users, so the status lookup doesn't have to.
+    if app_settings.STATUS_TABLE and created and not raw:
+        TwoFactorStatus.objects.create(user_id=instance.pk, has_2fa=False)
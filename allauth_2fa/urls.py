@@ -2,27 +2,46 @@ from __future__ import annotations
 
 from django.urls import path
 
+from allauth_2fa import app_settings
 from allauth_2fa import views
 
+if app_settings.ASYNC_VIEWS:
+    from allauth_2fa import async_views
+
+    authenticate_view = async_views.AsyncTwoFactorAuthenticate
+    setup_view = async_views.AsyncTwoFactorSetup
+    backup_tokens_view = async_views.AsyncTwoFactorBackupTokens
+    remove_view = async_views.AsyncTwoFactorRemove
+else:
+    authenticate_view = views.TwoFactorAuthenticate
+    setup_view = views.TwoFactorSetup
+    backup_tokens_view = views.TwoFactorBackupTokens
+    remove_view = views.TwoFactorRemove
+
 urlpatterns = [
     path(
         "authenticate/",
-        views.TwoFactorAuthenticate.as_view(),
+        authenticate_view.as_view(),
         name="two-factor-authenticate",
     ),
     path(
         "setup/",
-        views.TwoFactorSetup.as_view(),
+        setup_view.as_view(),
         name="two-factor-setup",
     ),
+    path(
+        "setup/qr/",
+        views.TwoFactorSetupQRCode.as_view(),
+        name="two-factor-setup-qr",
+    ),
     path(
         "backup-tokens/",
-        views.TwoFactorBackupTokens.as_view(),
+        backup_tokens_view.as_view(),
         name="two-factor-backup-tokens",
     ),
     path(
         "remove/",
-        views.TwoFactorRemove.as_view(),
+        remove_view.as_view(),
         name="two-factor-remove",
     ),
 ]
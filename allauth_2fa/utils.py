@@ -1,21 +1,64 @@
 from __future__ import annotations
 
+import contextlib
+import secrets
 from base64 import b32encode
 from io import BytesIO
+from typing import Any
+from typing import Iterable
 from urllib.parse import quote
 from urllib.parse import urlencode
 
 import qrcode
+from asgiref.sync import sync_to_async
+from django.contrib.auth import HASH_SESSION_KEY
+from django.contrib.auth.middleware import get_user as get_request_user
+from django.contrib.sessions.backends.base import SessionBase
+from django.core.cache import BaseCache
+from django.core.cache import caches
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.db.models import Exists
+from django.db.models import OuterRef
+from django.db.models import QuerySet
+from django.db.models import Value
 from django.http import HttpRequest
 from django_otp.models import Device
-from qrcode.image.svg import SvgPathImage
+from django_otp.plugins.otp_static.models import StaticDevice
+from django_otp.plugins.otp_totp.models import TOTPDevice
+from qrcode.constants import ERROR_CORRECT_M
+
+from allauth_2fa import app_settings
+from allauth_2fa.instrumentation import measure
+from allauth_2fa.models import TwoFactorStatus
+
+# Attribute used to memoize the 2FA status on a user instance.
+# `request.user` is created anew for every request, so this effectively
+# caches the lookup for the duration of a single request.
+_HAS_DEVICE_ATTR = "_allauth_2fa_has_valid_totp_device"
+
+# The session key of the marker recording that the user of the session has
+# 2FA enabled, see `get_2fa_satisfied_marker`.
+SATISFIED_SESSION_KEY = "allauth_2fa_satisfied"
+
+# The session keys of a pending login, see `clear_pending_login`.
+PENDING_LOGIN_SESSION_KEYS = (
+    "allauth_2fa_user_id",
+    "allauth_2fa_device_ids",
+    "allauth_2fa_login",
+    "allauth_2fa_login_key",
+)
+
+# Attribute used to memoize the QR codes generated for a device instance.
+_QR_CODES_ATTR = "_allauth_2fa_qr_codes"
 
 
 def get_device_base32_secret(device: Device) -> str:
     return b32encode(device.bin_key).decode("utf-8")
 
 
-def generate_totp_config_svg(device: Device, issuer: str, label: str) -> bytes:
+def get_totp_config_url(device: Device, issuer: str, label: str) -> str:
     params = {
         "secret": get_device_base32_secret(device),
         "algorithm": "SHA1",
@@ -23,19 +66,481 @@ def generate_totp_config_svg(device: Device, issuer: str, label: str) -> bytes:
         "period": device.step,
         "issuer": issuer,
     }
+    return f"otpauth://totp/{quote(label)}?{urlencode(params)}"
+
+
+def generate_totp_config_svg(
+    device: Device,
+    issuer: str,
+    label: str,
+    *,
+    error_correction: int = ERROR_CORRECT_M,
+    box_size: int = 10,
+    border: int = 4,
+) -> bytes:
+    """
+    Generate an SVG QR code for configuring a token generator for the device.
+
+    `error_correction` is one of the `qrcode.constants.ERROR_CORRECT_*` levels,
+    and `box_size` is the size of a single module (10 equals 1mm).
+
+    The result is memoized on the device instance for as long as its
+    configuration (and the other arguments) stay the same.
+    """
+    with measure("qr_code.svg"):
+        return _get_qr_code(
+            render_qr_code_svg,
+            device,
+            issuer,
+            label,
+            error_correction=error_correction,
+            box_size=box_size,
+            border=border,
+        )
+
+
+def _get_qr_code(render, device: Device, issuer: str, label: str, **kwargs) -> bytes:
+    # The configuration URL contains the device's secret, so the QR codes are
+    # only kept for as long as the device instance is.
+    data = get_totp_config_url(device, issuer, label)
+    qr_codes = device.__dict__.setdefault(_QR_CODES_ATTR, {})
+    key = (render, data, tuple(sorted(kwargs.items())))
+    if key not in qr_codes:
+        qr_codes[key] = render(data, **kwargs)
+    return qr_codes[key]
+
+
+def render_qr_code_svg(
+    data: str,
+    *,
+    error_correction: int,
+    box_size: int,
+    border: int,
+) -> bytes:
+    qr = qrcode.QRCode(error_correction=error_correction, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+
+    # Draw each horizontal run of dark modules as a rectangle of a single
+    # path, in module units; the viewBox scales it to the requested size.
+    subpaths = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < len(row):
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < len(row) and row[x]:
+                x += 1
+            subpaths.append(f"M{start} {y}h{x - start}v1h-{x - start}z")
 
-    otpauth_url = f"otpauth://totp/{quote(label)}?{urlencode(params)}"
+    size = len(matrix)
+    dimension = f"{size * box_size / 10:g}mm"
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{dimension}" '
+        f'height="{dimension}" viewBox="0 0 {size} {size}">'
+        f'<path d="{"".join(subpaths)}" fill="#000000"/></svg>'
+    ).encode("ascii")
 
-    img = qrcode.make(otpauth_url, image_factory=SvgPathImage)
+
+def generate_totp_config_png(
+    device: Device,
+    issuer: str,
+    label: str,
+    *,
+    error_correction: int = ERROR_CORRECT_M,
+    box_size: int = 10,
+    border: int = 4,
+) -> bytes:
+    """
+    Generate a PNG QR code for configuring a token generator for the device.
+
+    This requires Pillow; see `generate_totp_config_svg` for the arguments.
+    """
+    with measure("qr_code.png"):
+        return _get_qr_code(
+            render_qr_code_png,
+            device,
+            issuer,
+            label,
+            error_correction=error_correction,
+            box_size=box_size,
+            border=border,
+        )
+
+
+def render_qr_code_png(
+    data: str,
+    *,
+    error_correction: int,
+    box_size: int,
+    border: int,
+) -> bytes:
+    from qrcode.image.pil import PilImage
+
+    qr = qrcode.QRCode(
+        error_correction=error_correction,
+        box_size=box_size,
+        border=border,
+        image_factory=PilImage,
+    )
+    qr.add_data(data)
     io = BytesIO()
-    img.save(io)
+    qr.make_image().save(io, format="PNG")
     return io.getvalue()
 
 
+def get_setup_device(request: HttpRequest) -> TOTPDevice | None:
+    """
+    Get the unconfirmed device the user is setting up, if any.
+
+    With `ALLAUTH_2FA_SETUP_KEY_IN_SESSION`, the device is not saved to the
+    database until it is confirmed; an unsaved device is built from the key
+    kept in the session instead.
+    """
+    if app_settings.SETUP_KEY_IN_SESSION:
+        key = request.session.get("allauth_2fa_setup_key")
+        if key is None:
+            return None
+        return TOTPDevice(user=request.user, key=key, confirmed=False)
+    return request.user.totpdevice_set.filter(confirmed=False).order_by("-pk").first()
+
+
+def get_status_cache() -> BaseCache | None:
+    """
+    Get the cache used to remember the 2FA status of users across requests,
+    or None if cross-request caching is disabled.
+    """
+    alias = app_settings.STATUS_CACHE
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def get_pending_login_cache() -> BaseCache | None:
+    """
+    Get the cache used to keep the pending login kwargs out of the session,
+    or None if they're kept in the session.
+    """
+    alias = app_settings.PENDING_LOGIN_CACHE
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def get_pending_login_cache_key(key: str) -> str:
+    return f"allauth_2fa:pending_login:{key}"
+
+
+def clear_pending_login(session: SessionBase) -> None:
+    """
+    Forget the login stashed in the session by
+    `OTPAdapter.stash_pending_login` (if any), including its entry in the
+    pending login cache.
+    """
+    key = session.get("allauth_2fa_login_key")
+    for session_key in PENDING_LOGIN_SESSION_KEYS:
+        session.pop(session_key, None)
+    cache = get_pending_login_cache()
+    if key is not None and cache is not None:
+        cache.delete(get_pending_login_cache_key(key))
+
+
+def get_status_cache_key(user_id) -> str:
+    return f"allauth_2fa:has_valid_totp_device:{user_id}"
+
+
+def _lookup_has_device(user) -> bool:
+    if not app_settings.STATUS_TABLE:
+        return user.totpdevice_set.filter(confirmed=True).exists()
+    has_device = (
+        TwoFactorStatus.objects.filter(pk=user.pk)
+        .values_list("has_2fa", flat=True)
+        .first()
+    )
+    if has_device is None:
+        # Not recorded yet; look it up from the devices.
+        has_device = user.totpdevice_set.filter(confirmed=True).exists()
+        update_status_table(user.pk, has_device)
+    return has_device
+
+
+async def _alookup_has_device(user) -> bool:
+    if not app_settings.STATUS_TABLE:
+        return await user.totpdevice_set.filter(confirmed=True).aexists()
+    has_device = (
+        await TwoFactorStatus.objects.filter(pk=user.pk)
+        .values_list("has_2fa", flat=True)
+        .afirst()
+    )
+    if has_device is None:
+        has_device = await user.totpdevice_set.filter(confirmed=True).aexists()
+        await sync_to_async(upsert_2fa_statuses)({user.pk: has_device})
+    return has_device
+
+
+def update_status_table(
+    user_id,
+    has_device: bool | None = None,
+    *,
+    create: bool = True,
+) -> None:
+    """
+    Record whether a user has 2FA enabled in the `TwoFactorStatus` table, in
+    a single query. If `has_device` is None, it's looked up from the devices.
+
+    If `create` is False, only an existing row is updated; e.g. the user may
+    be in the middle of being deleted, so a new row couldn't refer to them.
+    """
+    if has_device is None:
+        has_device = TOTPDevice.objects.filter(
+            user_id=user_id,
+            confirmed=True,
+        ).exists()
+    if create:
+        upsert_2fa_statuses({user_id: has_device})
+    else:
+        TwoFactorStatus.objects.filter(pk=user_id).update(has_2fa=has_device)
+
+
+def upsert_2fa_statuses(statuses: dict[Any, bool]) -> None:
+    """
+    Insert or update the `TwoFactorStatus` rows of the given users (a mapping
+    of user IDs to whether they have 2FA enabled), in a single query if the
+    database supports it.
+    """
+    rows = [
+        TwoFactorStatus(user_id=user_id, has_2fa=has_2fa)
+        for user_id, has_2fa in statuses.items()
+    ]
+    features = connections[router.db_for_write(TwoFactorStatus)].features
+    if features.supports_update_conflicts_with_target:
+        # e.g. PostgreSQL and SQLite
+        unique_fields = ["user"]
+    elif features.supports_update_conflicts:
+        # e.g. MySQL, which updates on any unique constraint conflict
+        unique_fields = None
+    else:
+        for row in rows:
+            TwoFactorStatus.objects.update_or_create(
+                user_id=row.user_id,
+                defaults={"has_2fa": row.has_2fa},
+            )
+        return
+    TwoFactorStatus.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=["has_2fa", "updated_at"],
+    )
+
+
+def _get_cached_status(cached, generation: str | None) -> bool | None:
+    # The status is cached along with the device generation it was looked up
+    # in; once the generation changes, the status may be out of date (e.g. a
+    # lookup that raced with a device change cached the old status).
+    if cached is None or generation is None or cached[0] != generation:
+        return None
+    return cached[1]
+
+
 def user_has_valid_totp_device(user) -> bool:
     if not user.is_authenticated:
         return False
-    return user.totpdevice_set.filter(confirmed=True).exists()
+
+    try:
+        return getattr(user, _HAS_DEVICE_ATTR)
+    except AttributeError:
+        pass
+
+    cache = get_status_cache()
+    if cache is None:
+        has_device = _lookup_has_device(user)
+    else:
+        status_key = get_status_cache_key(user.pk)
+        generation_key = get_device_generation_key(user.pk)
+        cached = cache.get_many([status_key, generation_key])
+        generation = cached.get(generation_key)
+        has_device = _get_cached_status(cached.get(status_key), generation)
+        if has_device is None:
+            if generation is None:
+                generation = get_device_generation(user.pk, create=True)
+            has_device = _lookup_has_device(user)
+            cache.set(
+                status_key,
+                (generation, has_device),
+                app_settings.STATUS_CACHE_TIMEOUT,
+            )
+
+    setattr(user, _HAS_DEVICE_ATTR, has_device)
+    return has_device
+
+
+async def auser_has_valid_totp_device(user) -> bool:
+    """Async version of `user_has_valid_totp_device`."""
+    if not user.is_authenticated:
+        return False
+
+    try:
+        return getattr(user, _HAS_DEVICE_ATTR)
+    except AttributeError:
+        pass
+
+    cache = get_status_cache()
+    if cache is None:
+        has_device = await _alookup_has_device(user)
+    else:
+        status_key = get_status_cache_key(user.pk)
+        generation_key = get_device_generation_key(user.pk)
+        cached = await cache.aget_many([status_key, generation_key])
+        generation = cached.get(generation_key)
+        has_device = _get_cached_status(cached.get(status_key), generation)
+        if has_device is None:
+            if generation is None:
+                generation = await aget_device_generation(user.pk, create=True)
+            has_device = await _alookup_has_device(user)
+            await cache.aset(
+                status_key,
+                (generation, has_device),
+                app_settings.STATUS_CACHE_TIMEOUT,
+            )
+
+    setattr(user, _HAS_DEVICE_ATTR, has_device)
+    return has_device
+
+
+def has_2fa_expression(user_ref: str = "pk") -> Exists:
+    """
+    Get an expression that's true if the user referred to by `user_ref` (in
+    the outer query) has 2FA enabled, e.g. for filtering a user queryset.
+    """
+    return Exists(
+        TOTPDevice.objects.filter(user=OuterRef(user_ref), confirmed=True),
+    )
+
+
+def with_2fa_status(queryset: QuerySet, name: str = "has_2fa") -> QuerySet:
+    """
+    Annotate a queryset of users with whether they have 2FA enabled, as the
+    boolean attribute `name`, so it's looked up in the same query.
+    """
+    return queryset.annotate(**{name: has_2fa_expression()})
+
+
+def get_2fa_statuses(users: QuerySet | Iterable[Any]) -> dict[Any, bool]:
+    """
+    Get whether each of the given users has 2FA enabled, keyed by their
+    primary keys, in a single query.
+
+    `users` is either a queryset of users or an iterable of user IDs.
+    """
+    if isinstance(users, QuerySet):
+        return dict(with_2fa_status(users).values_list("pk", "has_2fa"))
+    user_ids = list(users)
+    enabled = set(
+        TOTPDevice.objects.filter(user_id__in=user_ids, confirmed=True).values_list(
+            "user_id",
+            flat=True,
+        ),
+    )
+    return {user_id: user_id in enabled for user_id in user_ids}
+
+
+def forget_totp_device_status(user_id, user=None, using=None) -> None:
+    """
+    Forget the cached 2FA status of a user, so it will be looked up from the
+    database the next time it is needed, and invalidate the "2FA enabled"
+    session markers of the user's sessions.
+
+    The status memoized on `user` (if given) is forgotten right away; the
+    status cache is only invalidated once the current transaction (on the
+    `using` database) is committed, so a concurrent lookup can't cache the
+    status from before the change, and nothing is cached if it's rolled back.
+    """
+    if user is not None:
+        with contextlib.suppress(AttributeError):
+            delattr(user, _HAS_DEVICE_ATTR)
+
+    cache = get_status_cache()
+    if cache is None:
+        return
+
+    def invalidate() -> None:
+        # Changing the generation invalidates any cached status too.
+        cache.set(get_device_generation_key(user_id), secrets.token_hex(8), None)
+        cache.delete(get_status_cache_key(user_id))
+
+    transaction.on_commit(invalidate, using=using)
+
+
+def get_device_generation_key(user_id) -> str:
+    return f"allauth_2fa:device_generation:{user_id}"
+
+
+def get_device_generation(user_id, *, create: bool = False) -> str | None:
+    """
+    Get the current "generation" of a user's devices from the status cache.
+    The generation changes whenever a device of the user is confirmed,
+    removed or unconfirmed.
+
+    Returns None if the status cache is disabled, or if the generation isn't
+    known and `create` is False.
+    """
+    cache = get_status_cache()
+    if cache is None:
+        return None
+    key = get_device_generation_key(user_id)
+    generation = cache.get(key)
+    if generation is None and create:
+        cache.add(key, secrets.token_hex(8), None)
+        generation = cache.get(key)
+    return generation
+
+
+async def aget_device_generation(user_id, *, create: bool = False) -> str | None:
+    """Async version of `get_device_generation`."""
+    cache = get_status_cache()
+    if cache is None:
+        return None
+    key = get_device_generation_key(user_id)
+    generation = await cache.aget(key)
+    if generation is None and create:
+        await cache.aadd(key, secrets.token_hex(8), None)
+        generation = await cache.aget(key)
+    return generation
+
+
+def get_2fa_satisfied_marker(request: HttpRequest, generation: str | None) -> list:
+    """
+    Get the value of the session marker recording that the user of the
+    session has 2FA enabled. The marker is tied to the session's auth hash (so
+    it's invalidated e.g. when the password is changed) and to the generation
+    of the user's devices.
+    """
+    return [request.session.get(HASH_SESSION_KEY), generation]
+
+
+def get_device_ids(user) -> dict[str, list]:
+    """
+    Get the primary keys of the user's confirmed TOTP and static devices,
+    keyed by device type ("totp" or "static"), in a single query.
+    """
+    totp_devices = (
+        TOTPDevice.objects.filter(user=user, confirmed=True)
+        .annotate(device_type=Value("totp"))
+        .values_list("device_type", "pk")
+    )
+    static_devices = (
+        StaticDevice.objects.filter(user=user, confirmed=True)
+        .annotate(device_type=Value("static"))
+        .values_list("device_type", "pk")
+    )
+    device_ids = {"totp": [], "static": []}
+    for device_type, pk in totp_devices.union(static_devices, all=True):
+        device_ids[device_type].append(pk)
+    return device_ids
 
 
 def get_next_query_string(request: HttpRequest) -> str | None:
@@ -62,3 +567,29 @@ def get_next_query_string(request: HttpRequest) -> str | None:
     if query_params:
         return f"?{urlencode(query_params)}"
     return None
+
+
+async def aload_session(session: SessionBase) -> None:
+    """
+    Load the session data without blocking the event loop, so the session can
+    then be read and modified without hitting the session backend.
+    """
+    if hasattr(session, "akeys"):
+        # Django 5.0+
+        await session.akeys()
+    else:
+        await sync_to_async(session.keys)()
+
+
+async def aget_user(request: HttpRequest):
+    """
+    Get the user of the request without blocking the event loop.
+    """
+    if hasattr(request, "auser"):
+        # Django 5.0+
+        user = await request.auser()
+        # Make sure accessing `request.user` won't hit the database again.
+        request.user = user
+        return user
+    # This caches the user for the lazy `request.user` too.
+    return await sync_to_async(get_request_user)(request)
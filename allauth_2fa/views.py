@@ -1,18 +1,28 @@
 from __future__ import annotations
 
+import hashlib
 from base64 import b64encode
+from typing import Any
 
 from allauth.account.adapter import get_adapter
 from allauth.utils import get_form_class
 from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.sites.shortcuts import get_current_site
+from django.db import transaction
+from django.http import Http404
+from django.http import HttpResponse
 from django.http import HttpResponseRedirect
 from django.shortcuts import redirect
+from django.urls import reverse
 from django.urls import reverse_lazy
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
 from django.utils.encoding import force_str
+from django.utils.http import quote_etag
 from django.views.generic import FormView
 from django.views.generic import TemplateView
+from django.views.generic import View
 from django_otp.plugins.otp_static.models import StaticToken
 from django_otp.plugins.otp_totp.models import TOTPDevice
 
@@ -20,9 +30,13 @@ from allauth_2fa import app_settings
 from allauth_2fa.forms import TOTPAuthenticateForm
 from allauth_2fa.forms import TOTPDeviceForm
 from allauth_2fa.forms import TOTPDeviceRemoveForm
+from allauth_2fa.instrumentation import measure
 from allauth_2fa.mixins import ValidTOTPDeviceRequiredMixin
+from allauth_2fa.utils import SATISFIED_SESSION_KEY
+from allauth_2fa.utils import generate_totp_config_png
 from allauth_2fa.utils import generate_totp_config_svg
 from allauth_2fa.utils import get_device_base32_secret
+from allauth_2fa.utils import get_setup_device
 from allauth_2fa.utils import user_has_valid_totp_device
 
 
@@ -45,10 +59,21 @@ class TwoFactorAuthenticate(FormView):
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
-        user_id = self.request.session["allauth_2fa_user_id"]
-        kwargs["user"] = get_user_model().objects.get(id=user_id)
+        kwargs["user"] = self.get_pending_user()
+        kwargs["request"] = self.request
+        # Not set if the login was stashed by an older version.
+        device_ids = self.request.session.get("allauth_2fa_device_ids")
+        if device_ids is not None:
+            kwargs["device_ids"] = device_ids
         return kwargs
 
+    def get_pending_user(self):
+        """Get the user who is about to enter their two-factor credentials."""
+        if not hasattr(self, "pending_user"):
+            user_id = self.request.session["allauth_2fa_user_id"]
+            self.pending_user = get_user_model().objects.get(id=user_id)
+        return self.pending_user
+
     def form_valid(self, form):
         """
         The allauth 2fa login flow is now done (the user logged in successfully
@@ -57,13 +82,37 @@ class TwoFactorAuthenticate(FormView):
 
         """
         adapter = get_adapter(self.request)
-        # 2fa kicked in at `pre_login()`, so we need to continue from there.
-        login_kwargs = adapter.unstash_pending_login_kwargs(self.request)
-        adapter.login(self.request, form.user)
-        return adapter.post_login(self.request, form.user, **login_kwargs)
+        with measure("authenticate.complete_login"):
+            # 2fa kicked in at `pre_login()`, so we need to continue from there.
+            login_kwargs = adapter.unstash_pending_login_kwargs(self.request)
+            adapter.login(self.request, form.user)
+            return adapter.post_login(self.request, form.user, **login_kwargs)
+
+
+class TOTPConfigQRCodeMixin:
+    def get_qr_code_kwargs(self) -> dict[str, Any]:
+        """
+        Get the configuration for generating a QR code.
+
+        The fields required are:
+        - `label`: identifies which account a key is associated with. Contains an
+            account name, preferably prefixed by an issuer name and a colon, e.g.
+            `issuer: account`.
+        - `issuer`: indicates the provider or service this account is associated with.
+
+        `error_correction` and `box_size` may also be set; see
+        `allauth_2fa.utils.generate_totp_config_svg`.
+        """
+
+        issuer = get_current_site(self.request).name
+
+        return {
+            "issuer": issuer,
+            "label": f"{issuer}: {self.request.user.get_username()}",
+        }
 
 
-class TwoFactorSetup(LoginRequiredMixin, FormView):
+class TwoFactorSetup(LoginRequiredMixin, TOTPConfigQRCodeMixin, FormView):
     template_name = f"allauth_2fa/setup.{app_settings.TEMPLATE_EXTENSION}"
     form_class = TOTPDeviceForm
     success_url = reverse_lazy(app_settings.SETUP_SUCCESS_URL)
@@ -81,7 +130,14 @@ class TwoFactorSetup(LoginRequiredMixin, FormView):
 
         This needs to be done whenever a GET request to the page is received OR
         if the confirmation of the device fails.
+
+        With `ALLAUTH_2FA_SETUP_KEY_IN_SESSION`, the new device isn't saved;
+        only its key is kept in the session.
         """
+        if app_settings.SETUP_KEY_IN_SESSION:
+            self.device = TOTPDevice(user=self.request.user, confirmed=False)
+            self.request.session["allauth_2fa_setup_key"] = self.device.key
+            return
         self.request.user.totpdevice_set.filter(confirmed=False).delete()
         self.device = TOTPDevice.objects.create(user=self.request.user, confirmed=False)
 
@@ -91,24 +147,6 @@ class TwoFactorSetup(LoginRequiredMixin, FormView):
         self._new_device()
         return super().get(request, *args, **kwargs)
 
-    def get_qr_code_kwargs(self) -> dict[str, str]:
-        """
-        Get the configuration for generating a QR code.
-
-        The fields required are:
-        - `label`: identifies which account a key is associated with. Contains an
-            account name, preferably prefixed by an issuer name and a colon, e.g.
-            `issuer: account`.
-        - `issuer`: indicates the provider or service this account is associated with.
-        """
-
-        issuer = get_current_site(self.request).name
-
-        return {
-            "issuer": issuer,
-            "label": f"{issuer}: {self.request.user.get_username()}",
-        }
-
     def get_qr_code_data_uri(self):
         svg_data = generate_totp_config_svg(
             device=self.device,
@@ -116,9 +154,14 @@ class TwoFactorSetup(LoginRequiredMixin, FormView):
         )
         return f"data:image/svg+xml;base64,{force_str(b64encode(svg_data))}"
 
+    def get_qr_code_url(self) -> str:
+        if app_settings.SETUP_QR_CODE_INLINE:
+            return self.get_qr_code_data_uri()
+        return reverse("two-factor-setup-qr")
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["qr_code_url"] = self.get_qr_code_data_uri()
+        context["qr_code_url"] = self.get_qr_code_url()
         context["secret"] = get_device_base32_secret(self.device)
         return context
 
@@ -128,11 +171,14 @@ class TwoFactorSetup(LoginRequiredMixin, FormView):
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         kwargs["user"] = self.request.user
+        if app_settings.SETUP_KEY_IN_SESSION:
+            kwargs["device"] = get_setup_device(self.request)
         return kwargs
 
     def form_valid(self, form):
         # Confirm the device.
         form.save()
+        self.request.session.pop("allauth_2fa_setup_key", None)
         return super().form_valid(form)
 
     def form_invalid(self, form):
@@ -141,6 +187,42 @@ class TwoFactorSetup(LoginRequiredMixin, FormView):
         return super().form_invalid(form)
 
 
+class TwoFactorSetupQRCode(LoginRequiredMixin, TOTPConfigQRCodeMixin, View):
+    """
+    Serve the QR code for the user's unconfirmed device (created by the setup
+    page) as an SVG, or as a PNG with `?format=png` (requires Pillow).
+    """
+
+    def get(self, request, *args, **kwargs):
+        device = get_setup_device(request)
+        if device is None:
+            raise Http404("No device is being set up.")
+        image_format = request.GET.get("format", "svg")
+        if image_format == "svg":
+            content_type = "image/svg+xml"
+            generate = generate_totp_config_svg
+        elif image_format == "png":
+            content_type = "image/png"
+            generate = generate_totp_config_png
+        else:
+            raise Http404("Unknown image format.")
+        try:
+            content = generate(device=device, **self.get_qr_code_kwargs())
+        except ImportError as exc:
+            raise Http404("Unsupported image format.") from exc
+
+        etag = quote_etag(hashlib.sha256(content).hexdigest())
+        response = get_conditional_response(request, etag=etag) or HttpResponse(
+            content,
+            content_type=content_type,
+        )
+        response.headers["ETag"] = etag
+        # The QR code contains the secret key; it must not end up in shared
+        # caches, and must be revalidated as the device changes.
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
 class TwoFactorRemove(ValidTOTPDeviceRequiredMixin, FormView):
     template_name = f"allauth_2fa/remove.{app_settings.TEMPLATE_EXTENSION}"
     form_class = TOTPDeviceRemoveForm
@@ -151,11 +233,13 @@ class TwoFactorRemove(ValidTOTPDeviceRequiredMixin, FormView):
 
     def form_valid(self, form):
         form.save()
+        self.request.session.pop(SATISFIED_SESSION_KEY, None)
         return super().form_valid(form)
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         kwargs["user"] = self.request.user
+        kwargs["request"] = self.request
         return kwargs
 
 
@@ -166,21 +250,31 @@ class TwoFactorBackupTokens(ValidTOTPDeviceRequiredMixin, TemplateView):
     reveal_tokens = bool(app_settings.ALWAYS_REVEAL_BACKUP_TOKENS)
 
     def get_context_data(self, **kwargs):
+        kwargs.setdefault("backup_tokens", self.get_backup_tokens())
         context = super().get_context_data(**kwargs)
-        static_device, _ = self.request.user.staticdevice_set.get_or_create(
-            name="backup",
-        )
+        context["reveal_tokens"] = self.reveal_tokens
+        return context
 
-        if static_device:
-            context["backup_tokens"] = static_device.token_set.all()
-            context["reveal_tokens"] = self.reveal_tokens
+    def get_backup_tokens(self):
+        return StaticToken.objects.filter(
+            device__user=self.request.user,
+            device__name="backup",
+        )
 
-        return context
+    def generate_backup_tokens(self) -> list[StaticToken]:
+        """Replace the user's backup tokens with new ones."""
+        with transaction.atomic():
+            static_device, _ = self.request.user.staticdevice_set.get_or_create(
+                name="backup",
+            )
+            static_device.token_set.all().delete()
+            return StaticToken.objects.bulk_create(
+                StaticToken(device=static_device, token=StaticToken.random_token())
+                for _ in range(app_settings.BACKUP_TOKENS_NUMBER)
+            )
 
     def post(self, request, *args, **kwargs):
-        static_device, _ = request.user.staticdevice_set.get_or_create(name="backup")
-        static_device.token_set.all().delete()
-        for _ in range(app_settings.BACKUP_TOKENS_NUMBER):
-            static_device.token_set.create(token=StaticToken.random_token())
+        backup_tokens = self.generate_backup_tokens()
         self.reveal_tokens = True
-        return self.get(request, *args, **kwargs)
+        context = self.get_context_data(backup_tokens=backup_tokens, **kwargs)
+        return self.render_to_response(context)
@@ -0,0 +1,70 @@
+"""
+Compare the requests per second of the sync and async 2FA views when served
+through the ASGI handler (Django's AsyncClient).
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+from benchmarks.utils import create_user
+from benchmarks.utils import setup_django
+from benchmarks.utils import timed
+
+URLCONFS = {
+    "sync": "tests.urls",
+    "async": "tests.async_urls",
+}
+
+
+async def run_requests(client, url: str, requests: int, concurrency: int) -> None:
+    for _ in range(requests // concurrency):
+        responses = await asyncio.gather(
+            *(client.get(url) for _ in range(concurrency)),
+        )
+        for response in responses:
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--requests", type=int, default=500)
+    parser.add_argument("-c", "--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    setup_django()
+
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncClient
+    from django.test import override_settings
+    from django.urls import reverse
+
+    users = {
+        "two-factor-setup": create_user("setup"),
+        "two-factor-backup-tokens": create_user("backup", with_totp=True),
+        "two-factor-remove": create_user("remove", with_totp=True),
+    }
+
+    for url_name, user in users.items():
+        for label, urlconf in URLCONFS.items():
+            with override_settings(ROOT_URLCONF=urlconf):
+                client = AsyncClient()
+                client.force_login(user)
+                url = reverse(url_name)
+                # Warm up.
+                async_to_sync(run_requests)(client, url, 10, 1)
+                with timed() as timer:
+                    async_to_sync(run_requests)(
+                        client,
+                        url,
+                        args.requests,
+                        args.concurrency,
+                    )
+            rps = args.requests / timer.elapsed
+            print(f"{url_name:<26} {label:<6} {rps:10.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Measure the wall time and the number of database queries of each 2FA flow
+(see `tests/flows.py`) and of `allauth_2fa_migrate`, and check the query
+counts against their budgets. Exits with a non-zero status if a budget is
+exceeded.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from contextlib import contextmanager
+from io import StringIO
+
+from benchmarks.utils import setup_django
+from benchmarks.utils import timed
+
+
+def create_users_to_migrate(n_users: int) -> None:
+    from django.contrib.auth import get_user_model
+    from django_otp.plugins.otp_static.models import StaticDevice
+    from django_otp.plugins.otp_static.models import StaticToken
+    from django_otp.plugins.otp_totp.models import TOTPDevice
+
+    users = get_user_model().objects.bulk_create(
+        get_user_model()(username=f"migrate{i}") for i in range(n_users)
+    )
+    TOTPDevice.objects.bulk_create(
+        TOTPDevice(user=user, confirmed=True) for user in users
+    )
+    static_devices = StaticDevice.objects.bulk_create(
+        StaticDevice(user=user, name="backup") for user in users
+    )
+    StaticToken.objects.bulk_create(
+        StaticToken(device=device, token=StaticToken.random_token())
+        for device in static_devices
+        for _ in range(3)
+    )
+
+
+def print_result(name: str, ms: float, n_queries: int, budget: int) -> bool:
+    ok = n_queries <= budget
+    print(
+        f"{name:<24} {ms:10.2f} ms {n_queries:4d} queries "
+        f"(budget {budget:4d}){'' if ok else ' OVER BUDGET'}",
+    )
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument(
+        "--migrate-users",
+        default="1000,10000,100000",
+        help="Comma-separated numbers of users to run allauth_2fa_migrate for.",
+    )
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.contrib.auth import get_user_model
+    from django.core.management import call_command
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    from tests.flows import FLOWS
+    from tests.flows import MIGRATE_QUERY_BUDGET_PER_BATCH
+    from tests.flows import QUERY_BUDGETS
+    from tests.flows import count_queries
+
+    over_budget = []
+
+    for name, flow in FLOWS.items():
+        elapsed = 0.0
+        n_queries = 0
+
+        @contextmanager
+        def measure():
+            nonlocal elapsed, n_queries
+            with CaptureQueriesContext(connection) as queries, timed() as timer:
+                yield
+            elapsed += timer.elapsed
+            n_queries = max(n_queries, count_queries(queries))
+
+        for _ in range(args.iterations):
+            flow(Client(), measure)
+        ms = elapsed / args.iterations * 1000
+        if not print_result(name, ms, n_queries, QUERY_BUDGETS[name]):
+            over_budget.append(name)
+
+    for n_users in [int(n) for n in args.migrate_users.split(",") if n]:
+        get_user_model().objects.all().delete()
+        create_users_to_migrate(n_users)
+        name = f"migrate {n_users} users"
+        # One more query finds that there are no more users to migrate.
+        n_batches = -(-n_users // 1000)
+        budget = MIGRATE_QUERY_BUDGET_PER_BATCH * n_batches + 1
+        with CaptureQueriesContext(connection) as queries, timed() as timer:
+            call_command("allauth_2fa_migrate", verbosity=0, stdout=StringIO())
+        n_queries = count_queries(queries)
+        if not print_result(name, timer.elapsed * 1000, n_queries, budget):
+            over_budget.append(name)
+
+    if over_budget:
+        sys.exit(f"Over the query budget: {', '.join(over_budget)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Compare the construction and validation throughput of the 2FA forms with the
+token field declared on the class, and with the token widget configured (or,
+for the remove form, the whole field built) in `__init__`, as the forms used
+to do.
+"""
+
+from __future__ import annotations
+
+import argparse
+
+from benchmarks.utils import create_user
+from benchmarks.utils import setup_django
+from benchmarks.utils import timed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django import forms
+    from django.utils.translation import gettext_lazy as _
+    from django_otp.plugins.otp_totp.models import TOTPDevice
+
+    from allauth_2fa.forms import DEFAULT_TOKEN_WIDGET_ATTRS
+    from allauth_2fa.forms import TOTPAuthenticateForm
+    from allauth_2fa.forms import TOTPDeviceForm
+    from allauth_2fa.forms import TOTPDeviceRemoveForm
+
+    class PerInstanceAuthenticateForm(TOTPAuthenticateForm):
+        otp_token = forms.CharField(label=_("Token"))
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.fields["otp_token"].widget.attrs.update(DEFAULT_TOKEN_WIDGET_ATTRS)
+
+    class PerInstanceDeviceForm(TOTPDeviceForm):
+        otp_token = forms.CharField(label=_("Token"))
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.fields["otp_token"].widget.attrs.update(DEFAULT_TOKEN_WIDGET_ATTRS)
+
+    class PerInstanceRemoveForm(TOTPDeviceRemoveForm):
+        otp_token = None
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.fields["otp_token"] = forms.CharField(label=_("Token"))
+            self.fields["otp_token"].widget.attrs.update(DEFAULT_TOKEN_WIDGET_ATTRS)
+
+    user = create_user("forms", with_totp=True)
+    # An unsaved device, so validating the setup form doesn't hit the database.
+    setup_device = TOTPDevice(user=user, confirmed=False)
+    # An invalid token; with no device IDs, validating the authenticate form
+    # doesn't query the devices. Validating the remove form does, and also
+    # throttles (i.e. saves) them.
+    data = {"otp_token": "abcdef"}
+
+    for label, form_cls, kwargs in [
+        ("authenticate", TOTPAuthenticateForm, {"device_ids": {}}),
+        ("authenticate, per-instance", PerInstanceAuthenticateForm, {"device_ids": {}}),
+        ("setup", TOTPDeviceForm, {"device": setup_device}),
+        ("setup, per-instance", PerInstanceDeviceForm, {"device": setup_device}),
+        ("remove", TOTPDeviceRemoveForm, {}),
+        ("remove, per-instance", PerInstanceRemoveForm, {}),
+    ]:
+        form_cls(user=user, data=data, **kwargs).is_valid()  # Warm up.
+        with timed() as construct_timer:
+            for _i in range(args.iterations):
+                form_cls(user=user, **kwargs)
+        with timed() as validate_timer:
+            for _i in range(args.iterations):
+                form_cls(user=user, data=data, **kwargs).is_valid()
+        print(
+            f"{label:<28} "
+            f"{args.iterations / construct_timer.elapsed:10.0f} constructed/s "
+            f"{args.iterations / validate_timer.elapsed:10.0f} validated/s",
+        )
+
+
+if __name__ == "__main__":
+    main()
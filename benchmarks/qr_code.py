@@ -0,0 +1,67 @@
+"""
+Compare the per-render latency of the TOTP setup QR code: the `qrcode` SVG
+path image the setup view used to render, the direct SVG renderer in
+`allauth_2fa.utils`, and the result of the latter memoized on the device.
+"""
+
+from __future__ import annotations
+
+import argparse
+from io import BytesIO
+
+from benchmarks.utils import setup_django
+from benchmarks.utils import timed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--renders", type=int, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+
+    import qrcode
+    from django_otp.plugins.otp_totp.models import TOTPDevice
+    from qrcode.constants import ERROR_CORRECT_M
+    from qrcode.image.svg import SvgPathImage
+
+    from allauth_2fa.utils import generate_totp_config_svg
+    from allauth_2fa.utils import get_totp_config_url
+    from allauth_2fa.utils import render_qr_code_svg
+
+    device = TOTPDevice()
+    kwargs = {"issuer": "example.com", "label": "example.com: username"}
+
+    def render_svg_path_image():
+        io = BytesIO()
+        qrcode.make(
+            get_totp_config_url(device, **kwargs),
+            image_factory=SvgPathImage,
+        ).save(io)
+
+    def render_uncached():
+        render_qr_code_svg(
+            get_totp_config_url(device, **kwargs),
+            error_correction=ERROR_CORRECT_M,
+            box_size=10,
+            border=4,
+        )
+
+    def render_cached():
+        generate_totp_config_svg(device, **kwargs)
+
+    for label, render in [
+        ("qrcode SvgPathImage", render_svg_path_image),
+        ("direct SVG", render_uncached),
+        ("direct SVG, memoized", render_cached),
+    ]:
+        render()  # Warm up.
+        with timed() as timer:
+            for _ in range(args.renders):
+                render()
+        per_render = timer.elapsed / args.renders * 1000
+        print(f"{label:<22} {per_render:8.3f} ms/render")
+
+
+if __name__ == "__main__":
+    main()
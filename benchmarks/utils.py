@@ -0,0 +1,53 @@
+"""
+Helpers for the standalone benchmark scripts in this directory.
+
+The scripts use the test settings and an in-memory SQLite database, and are
+run from the repository root, e.g. `python -m benchmarks.asgi_views`.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from contextlib import contextmanager
+
+
+def setup_django() -> None:
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+    import django
+
+    django.setup()
+
+    from django.test.utils import setup_databases
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    setup_databases(verbosity=0, interactive=False)
+
+
+def create_user(username: str, *, with_totp: bool = False):
+    from django.contrib.auth import get_user_model
+    from django_otp.plugins.otp_static.models import StaticToken
+
+    user = get_user_model().objects.create(username=username)
+    if with_totp:
+        user.totpdevice_set.create(confirmed=True)
+        static_device = user.staticdevice_set.create(name="backup")
+        static_device.token_set.create(token=StaticToken.random_token())
+    return user
+
+
+class Timer:
+    elapsed = 0.0
+
+
+@contextmanager
+def timed():
+    """Measure the wall time spent in the block."""
+    timer = Timer()
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        timer.elapsed = time.perf_counter() - start
@@ -0,0 +1,37 @@
+from django.urls import include
+from django.urls import path
+
+from allauth_2fa import async_views
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path(
+        "accounts/2fa/",
+        include(
+            [
+                path(
+                    "authenticate/",
+                    async_views.AsyncTwoFactorAuthenticate.as_view(),
+                    name="two-factor-authenticate",
+                ),
+                path(
+                    "setup/",
+                    async_views.AsyncTwoFactorSetup.as_view(),
+                    name="two-factor-setup",
+                ),
+                path(
+                    "backup-tokens/",
+                    async_views.AsyncTwoFactorBackupTokens.as_view(),
+                    name="two-factor-backup-tokens",
+                ),
+                path(
+                    "remove/",
+                    async_views.AsyncTwoFactorRemove.as_view(),
+                    name="two-factor-remove",
+                ),
+            ],
+        ),
+    ),
+    *sync_urlpatterns,
+]
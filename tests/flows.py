@@ -0,0 +1,180 @@
+"""
+The 2FA flows and their query budgets, shared by the query budget tests and
+`benchmarks/flows.py`.
+
+Each flow sets up what it needs, and runs the part to measure within the
+`measure()` context manager it's given.
+"""
+
+from __future__ import annotations
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import override_settings
+from django.urls import reverse
+from django_otp.oath import TOTP
+from django_otp.plugins.otp_static.models import StaticToken
+
+from allauth_2fa.middleware import BaseRequire2FAMiddleware
+
+PASSWORD = "doe"
+
+# The maximum number of queries (see `count_queries`) each flow may run.
+QUERY_BUDGETS = {
+    "login (pre_login)": 7,
+    "authenticate GET": 2,
+    "authenticate POST": 10,
+    "setup GET": 6,
+    "setup POST": 7,
+    "backup tokens GET": 4,
+    "backup tokens POST": 6,
+    "remove GET": 3,
+    "remove POST": 11,
+    "require 2FA middleware": 3,
+}
+
+# The maximum number of queries `allauth_2fa_migrate` may run per batch of
+# 1000 users. (SQLite limits the number of query parameters, so the
+# Authenticators of a batch are inserted with several queries.)
+MIGRATE_QUERY_BUDGET_PER_BATCH = 10
+
+TRANSACTION_STATEMENTS = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+def count_queries(queries: list[dict]) -> int:
+    """
+    Count the captured queries, ignoring transaction control statements, whose
+    number depends on whether the flow is run within a (test) transaction.
+    """
+    return sum(not query["sql"].startswith(TRANSACTION_STATEMENTS) for query in queries)
+
+
+class Require2FAMiddleware(BaseRequire2FAMiddleware):
+    def require_2fa(self, request):
+        return True
+
+
+def create_user(*, with_totp: bool = False):
+    user = get_user_model().objects.create(
+        username=f"user{get_user_model().objects.count()}",
+    )
+    user.set_password(PASSWORD)
+    user.save()
+    if with_totp:
+        user.totpdevice_set.create(confirmed=True)
+        static_device = user.staticdevice_set.create(name="backup")
+        static_device.token_set.create(token=StaticToken.random_token())
+    return user
+
+
+def get_token(device) -> str:
+    return TOTP(
+        key=device.bin_key,
+        step=device.step,
+        t0=device.t0,
+        digits=device.digits,
+    ).token()
+
+
+def login_pending(client, user) -> None:
+    client.post(
+        reverse("account_login"),
+        {"login": user.username, "password": PASSWORD},
+    )
+
+
+def flow_login(client, measure) -> None:
+    user = create_user(with_totp=True)
+    with measure():
+        resp = client.post(
+            reverse("account_login"),
+            {"login": user.username, "password": PASSWORD},
+        )
+    assert resp["Location"] == reverse("two-factor-authenticate")
+
+
+def flow_authenticate_get(client, measure) -> None:
+    login_pending(client, create_user(with_totp=True))
+    with measure():
+        resp = client.get(reverse("two-factor-authenticate"))
+    assert resp.status_code == 200
+
+
+def flow_authenticate_post(client, measure) -> None:
+    user = create_user(with_totp=True)
+    login_pending(client, user)
+    token = get_token(user.totpdevice_set.get())
+    with measure():
+        resp = client.post(reverse("two-factor-authenticate"), {"otp_token": token})
+    assert resp["Location"] == settings.LOGIN_REDIRECT_URL
+
+
+def flow_setup_get(client, measure) -> None:
+    client.force_login(create_user())
+    with measure():
+        resp = client.get(reverse("two-factor-setup"))
+    assert resp.status_code == 200
+
+
+def flow_setup_post(client, measure) -> None:
+    user = create_user()
+    client.force_login(user)
+    client.get(reverse("two-factor-setup"))
+    token = get_token(user.totpdevice_set.get())
+    with measure():
+        resp = client.post(reverse("two-factor-setup"), {"otp_token": token})
+    assert resp["Location"] == reverse("two-factor-backup-tokens")
+
+
+def flow_backup_tokens_get(client, measure) -> None:
+    client.force_login(create_user(with_totp=True))
+    with measure():
+        resp = client.get(reverse("two-factor-backup-tokens"))
+    assert resp.status_code == 200
+
+
+def flow_backup_tokens_post(client, measure) -> None:
+    client.force_login(create_user(with_totp=True))
+    with measure():
+        resp = client.post(reverse("two-factor-backup-tokens"))
+    assert resp.status_code == 200
+
+
+def flow_remove_get(client, measure) -> None:
+    client.force_login(create_user(with_totp=True))
+    with measure():
+        resp = client.get(reverse("two-factor-remove"))
+    assert resp.status_code == 200
+
+
+def flow_remove_post(client, measure) -> None:
+    user = create_user(with_totp=True)
+    client.force_login(user)
+    token = get_token(user.totpdevice_set.get())
+    with measure():
+        resp = client.post(reverse("two-factor-remove"), {"otp_token": token})
+    assert resp["Location"] == reverse("two-factor-setup")
+
+
+def flow_require_2fa_middleware(client, measure) -> None:
+    client.force_login(create_user(with_totp=True))
+    with override_settings(
+        MIDDLEWARE=(*settings.MIDDLEWARE, "tests.flows.Require2FAMiddleware"),
+    ):
+        with measure():
+            resp = client.get(reverse("login-required-view"))
+    assert resp.status_code == 200
+
+
+FLOWS = {
+    "login (pre_login)": flow_login,
+    "authenticate GET": flow_authenticate_get,
+    "authenticate POST": flow_authenticate_post,
+    "setup GET": flow_setup_get,
+    "setup POST": flow_setup_post,
+    "backup tokens GET": flow_backup_tokens_get,
+    "backup tokens POST": flow_backup_tokens_post,
+    "remove GET": flow_remove_get,
+    "remove POST": flow_remove_post,
+    "require 2FA middleware": flow_require_2fa_middleware,
+}
@@ -1,19 +1,50 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import re
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import FrozenInstanceError
+from datetime import timedelta
+from io import StringIO
+from types import ModuleType
 from typing import Callable
 from unittest.mock import Mock
+from unittest.mock import patch
+from xml.etree import ElementTree
 
 import pytest
+import qrcode
 from allauth.account.signals import user_logged_in
 from allauth.account.views import PasswordResetFromKeyView
+from asgiref.sync import async_to_sync
 from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import HASH_SESSION_KEY
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser
+from django.contrib.messages import get_messages
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import transaction
 from django.forms import BaseForm
+from django.http import HttpResponse
+from django.test import AsyncClient
+from django.test import AsyncRequestFactory
+from django.test import Client
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches
+from django.urls import path
 from django.urls import reverse
 from django.urls import reverse_lazy
+from django.utils import timezone
 from django.views.generic.edit import FormMixin
 from django_otp.oath import TOTP
 from django_otp.plugins.otp_static.models import StaticDevice
@@ -21,10 +52,42 @@ from django_otp.plugins.otp_static.models import StaticToken
 from django_otp.plugins.otp_totp.models import TOTPDevice
 from pytest_django.asserts import assertRedirects
 
+from allauth_2fa import app_settings
 from allauth_2fa import views
 from allauth_2fa.adapter import OTPAdapter
+from allauth_2fa.admin import TwoFactorStatusAdminMixin
+from allauth_2fa.admin import TwoFactorStatusListFilter
+from allauth_2fa.checks import check_settings
+from allauth_2fa.forms import DEFAULT_TOKEN_WIDGET_ATTRS
+from allauth_2fa.forms import TOTPAuthenticateForm
+from allauth_2fa.forms import TOTPDeviceForm
+from allauth_2fa.forms import TOTPDeviceRemoveForm
+from allauth_2fa.instrumentation import get_metrics_backend
+from allauth_2fa.middleware import AllauthTwoFactorMiddleware
 from allauth_2fa.middleware import BaseRequire2FAMiddleware
-
+from allauth_2fa.middleware import get_authenticate_paths
+from allauth_2fa.models import TwoFactorStatus
+from allauth_2fa.ratelimit import LocalRateLimiter
+from allauth_2fa.ratelimit import _load_rate_limiter
+from allauth_2fa.ratelimit import get_rate_limiter
+from allauth_2fa.replay import flush_device_usage
+from allauth_2fa.replay import verify_totp_device
+from allauth_2fa.utils import PENDING_LOGIN_SESSION_KEYS
+from allauth_2fa.utils import SATISFIED_SESSION_KEY
+from allauth_2fa.utils import auser_has_valid_totp_device
+from allauth_2fa.utils import generate_totp_config_svg
+from allauth_2fa.utils import get_2fa_statuses
+from allauth_2fa.utils import get_device_base32_secret
+from allauth_2fa.utils import get_device_generation
+from allauth_2fa.utils import get_device_ids
+from allauth_2fa.utils import get_pending_login_cache_key
+from allauth_2fa.utils import get_status_cache_key
+from allauth_2fa.utils import get_totp_config_url
+from allauth_2fa.utils import upsert_2fa_statuses
+from allauth_2fa.utils import user_has_valid_totp_device
+from allauth_2fa.utils import with_2fa_status
+
+from . import flows
 from . import forms as forms_overrides
 
 ADAPTER_CLASSES = [
@@ -119,6 +182,42 @@ def do_totp_authentication(
         assertRedirects(resp, expected_redirect_url, fetch_redirect_response=False)
 
 
+@pytest.mark.parametrize("expire", (False, True))
+def test_2fa_login_pending_login_cache(
+    client,
+    john_with_totp,
+    settings,
+    user_logged_in_count,
+    expire,
+):
+    user, totp_device, static_device = john_with_totp
+    settings.ALLAUTH_2FA_PENDING_LOGIN_CACHE = "default"
+    cache = caches["default"]
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+
+    # Only a reference to the cached login kwargs is kept in the session.
+    assert "allauth_2fa_login" not in client.session
+    cache_key = get_pending_login_cache_key(client.session["allauth_2fa_login_key"])
+    assert cache.get(cache_key)["email_verification"]
+
+    if expire:
+        cache.delete(cache_key)
+        token = get_token_from_totp_device(totp_device)
+        resp = client.post(TWO_FACTOR_AUTH_URL, {"otp_token": token})
+        assert resp.status_code == 403
+        assert user_logged_in_count() == 0
+        return
+
+    do_totp_authentication(
+        client,
+        totp_device=totp_device,
+        expected_redirect_url=settings.LOGIN_REDIRECT_URL,
+    )
+    assert user_logged_in_count() == 1
+    assert not set(PENDING_LOGIN_SESSION_KEYS) & set(client.session.keys())
+    assert cache.get(cache_key) is None
+
+
 @pytest.mark.parametrize("token_state", ["none", "correct", "incorrect"])
 def test_setup_2fa(client, john, token_state):
     """Test that the setup view works."""
@@ -146,6 +245,52 @@ def test_setup_2fa(client, john, token_state):
     assert device_confirmed == (token_state == "correct")
 
 
+@pytest.mark.parametrize("token_state", ["none", "correct", "incorrect"])
+def test_setup_2fa_key_in_session(client, john, settings, token_state):
+    settings.ALLAUTH_2FA_SETUP_KEY_IN_SESSION = True
+    settings.ALLAUTH_2FA_SETUP_QR_CODE_INLINE = False
+    client.force_login(john)
+
+    # Loading the setup page doesn't write devices to the database.
+    with CaptureQueriesContext(connection) as queries:
+        resp = client.get(TWO_FACTOR_SETUP_URL)
+    assert resp.status_code == 200
+    assert not [
+        q["sql"]
+        for q in queries
+        if q["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+        and "otp_totp_totpdevice" in q["sql"]
+    ]
+    assert not john.totpdevice_set.exists()
+    key = client.session["allauth_2fa_setup_key"]
+    totp_device = TOTPDevice(key=key)
+    assert resp.context["secret"] == get_device_base32_secret(totp_device)
+    assert client.get(reverse("two-factor-setup-qr")).content == (
+        generate_totp_config_svg(
+            totp_device,
+            issuer="example.com",
+            label="example.com: john",
+        )
+    )
+
+    if token_state == "correct":
+        form_data = {"otp_token": get_token_from_totp_device(totp_device)}
+    elif token_state == "incorrect":
+        form_data = {"otp_token": "123456"}
+    else:
+        form_data = {}
+    client.post(TWO_FACTOR_SETUP_URL, form_data)
+
+    if token_state == "correct":
+        assert john.totpdevice_set.get().key == key
+        assert john.totpdevice_set.get().confirmed
+        assert "allauth_2fa_setup_key" not in client.session
+    else:
+        assert not john.totpdevice_set.exists()
+        # A new key is generated when the confirmation fails.
+        assert client.session["allauth_2fa_setup_key"] != key
+
+
 def test_standard_login(client, john, user_logged_in_count):
     """Test login behavior when 2FA is not configured."""
     login(client, expected_redirect_url=settings.LOGIN_REDIRECT_URL)
@@ -203,22 +348,37 @@ def test_2fa_redirect(client, john):
     assertRedirects(resp, LOGIN_URL, fetch_redirect_response=False)
 
 
+@pytest.mark.parametrize("pending_login_cache", [None, "default"])
 @pytest.mark.parametrize("target_url", [LOGIN_URL, "/unnamed-view"])
-def test_2fa_reset_flow(client, john_with_totp, target_url):
+def test_2fa_reset_flow(
+    client,
+    john_with_totp,
+    settings,
+    target_url,
+    pending_login_cache,
+):
     """
     Ensure the login flow is reset when navigating away before entering
     two-factor credentials.
     """
+    settings.ALLAUTH_2FA_PENDING_LOGIN_CACHE = pending_login_cache
     login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
 
     # The user ID should be in the session.
     assert client.session.get("allauth_2fa_user_id")
+    if pending_login_cache:
+        cache_key = get_pending_login_cache_key(
+            client.session["allauth_2fa_login_key"],
+        )
+        assert caches[pending_login_cache].get(cache_key)
 
     # Navigate to a different page.
     client.get(target_url)
 
-    # The middleware should reset the login flow.
-    assert not client.session.get("allauth_2fa_user_id")
+    # The middleware should reset the login flow, forgetting all about it.
+    assert not set(PENDING_LOGIN_SESSION_KEYS) & set(client.session.keys())
+    if pending_login_cache:
+        assert caches[pending_login_cache].get(cache_key) is None
 
     # Trying to continue with two-factor without logging in again will
     # redirect to login.
@@ -347,6 +507,57 @@ def test_backup_tokens_number(client, john_with_totp):
         assert len(resp.context_data["backup_tokens"]) == 10
 
 
+@pytest.mark.parametrize("tokens_number", [3, 20])
+def test_backup_tokens_queries(
+    client,
+    john_with_totp,
+    settings,
+    django_assert_num_queries,
+    tokens_number,
+):
+    settings.ALLAUTH_2FA_BACKUP_TOKENS_NUMBER = tokens_number
+    user, totp_device, static_device = john_with_totp
+    client.force_login(user)
+
+    # Viewing the tokens doesn't write anything, even without a backup device.
+    with CaptureQueriesContext(connection) as queries:
+        resp = client.get(TWO_FACTOR_BACKUP_TOKENS_URL)
+    assert list(resp.context_data["backup_tokens"]) == []
+    assert not [
+        q["sql"] for q in queries if q["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+    ]
+    assert not user.staticdevice_set.filter(name="backup").exists()
+
+    # The number of queries doesn't depend on the number of tokens.
+    with django_assert_num_queries(11):
+        resp = client.post(TWO_FACTOR_BACKUP_TOKENS_URL)
+    tokens = [token.token for token in resp.context_data["backup_tokens"]]
+    assert len(tokens) == tokens_number
+    with django_assert_num_queries(8):
+        resp = client.post(TWO_FACTOR_BACKUP_TOKENS_URL)
+    new_tokens = [token.token for token in resp.context_data["backup_tokens"]]
+    assert len(new_tokens) == tokens_number
+    assert not set(tokens) & set(new_tokens)
+    resp = client.get(TWO_FACTOR_BACKUP_TOKENS_URL)
+    assert [token.token for token in resp.context_data["backup_tokens"]] == new_tokens
+
+
+@pytest.mark.parametrize("flow_name", list(flows.FLOWS))
+def test_query_budget(client, flow_name):
+    """Each 2FA flow runs at most the number of queries it's budgeted."""
+    n_queries = []
+
+    @contextmanager
+    def measure():
+        with CaptureQueriesContext(connection) as queries:
+            yield
+        n_queries.append(flows.count_queries(queries.captured_queries))
+
+    flows.FLOWS[flow_name](client, measure)
+    assert len(n_queries) == 1
+    assert n_queries[0] <= flows.QUERY_BUDGETS[flow_name]
+
+
 class Require2FA(BaseRequire2FAMiddleware):
     def require_2fa(self, request):
         return True
@@ -377,6 +588,64 @@ def test_require_2fa_middleware(client, john, settings, with_messages):
         # TODO: check messages?
 
 
+def test_require_2fa_middleware_message_dedup(client, john, settings):
+    settings.MIDDLEWARE += (
+        "django.contrib.messages.middleware.MessageMiddleware",
+        "tests.test_allauth_2fa.Require2FA",
+    )
+    settings.INSTALLED_APPS += ("django.contrib.messages",)
+    client.force_login(john)
+
+    def get_2fa_messages():
+        return [
+            message
+            for message in get_messages(resp.wsgi_request)
+            if message.extra_tags == "2fa_required"
+        ]
+
+    resp = client.get("/unnamed-view")
+    assertRedirects(resp, TWO_FACTOR_SETUP_URL, fetch_redirect_response=False)
+
+    # While the message is pending, the message storage isn't even loaded
+    # (let alone stored again) when redirecting.
+    with patch.object(FallbackStorage, "_get") as get_mock, patch.object(
+        FallbackStorage,
+        "_store",
+    ) as store_mock:
+        resp = client.get("/unnamed-view")
+    assertRedirects(resp, TWO_FACTOR_SETUP_URL, fetch_redirect_response=False)
+    get_mock.assert_not_called()
+    store_mock.assert_not_called()
+
+    # The message is shown on the setup page, once.
+    resp = client.get(TWO_FACTOR_SETUP_URL)
+    assert len(get_2fa_messages()) == 1
+
+    # After that, a redirect adds it again.
+    client.get("/unnamed-view")
+    resp = client.get(TWO_FACTOR_SETUP_URL)
+    assert len(get_2fa_messages()) == 1
+
+
+@pytest.mark.parametrize(
+    "form_cls",
+    [TOTPAuthenticateForm, TOTPDeviceForm, TOTPDeviceRemoveForm],
+)
+def test_token_widget_attrs(form_cls, john):
+    form = form_cls(user=john)
+    assert form.fields["otp_token"].required
+    assert form.fields["otp_token"].widget.attrs == DEFAULT_TOKEN_WIDGET_ATTRS
+    # The class-level field isn't shared with the form instances.
+    assert form.fields["otp_token"] is not form_cls.base_fields["otp_token"]
+
+
+def test_remove_form_without_token(john, settings):
+    settings.ALLAUTH_2FA_REQUIRE_OTP_ON_DEVICE_REMOVAL = False
+    form = TOTPDeviceRemoveForm(user=john, data={})
+    assert "otp_token" not in form.fields
+    assert form.is_valid()
+
+
 @pytest.mark.parametrize(
     ("settings_key", "custom_form_cls", "view_cls"),
     [
@@ -422,3 +691,1182 @@ def test_migration_management_command():
     auth_qs = Authenticator.objects
     assert auth_qs.filter(type=Authenticator.Type.RECOVERY_CODES).count() == 10
     assert auth_qs.filter(type=Authenticator.Type.TOTP).count() == 10
+
+
+@pytest.fixture()
+def status_cache(settings):
+    settings.ALLAUTH_2FA_STATUS_CACHE = "default"
+    caches["default"].clear()
+    yield caches["default"]
+    caches["default"].clear()
+
+
+def test_has_valid_totp_device_memoized(john_with_totp, django_assert_num_queries):
+    user, totp_device, static_device = john_with_totp
+    user = get_user_model().objects.get(pk=user.pk)
+    with django_assert_num_queries(1):
+        assert user_has_valid_totp_device(user)
+        assert user_has_valid_totp_device(user)
+
+
+def test_has_valid_totp_device_cached(
+    john_with_totp,
+    status_cache,
+    django_assert_num_queries,
+    django_capture_on_commit_callbacks,
+):
+    user, totp_device, static_device = john_with_totp
+    user_model = get_user_model()
+    user = user_model.objects.get(pk=user.pk)
+    with django_assert_num_queries(1):
+        assert user_has_valid_totp_device(user)
+    # A fresh user instance (i.e. the next request) hits the cache.
+    user = user_model.objects.get(pk=user.pk)
+    with django_assert_num_queries(0):
+        assert user_has_valid_totp_device(user)
+
+    # Deleting the device invalidates the cached status once committed.
+    with django_capture_on_commit_callbacks(execute=True):
+        totp_device.delete()
+    user = user_model.objects.get(pk=user.pk)
+    with django_assert_num_queries(1):
+        assert not user_has_valid_totp_device(user)
+
+    # So does confirming a device.
+    with django_capture_on_commit_callbacks(execute=True):
+        TOTPDevice.objects.create(user=user, confirmed=True)
+    user = user_model.objects.get(pk=user.pk)
+    with django_assert_num_queries(1):
+        assert user_has_valid_totp_device(user)
+    user = user_model.objects.get(pk=user.pk)
+    with django_assert_num_queries(0):
+        assert user_has_valid_totp_device(user)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("confirmed", (False, True))
+def test_has_valid_totp_device_cache_rollback(john, status_cache, confirmed):
+    if confirmed:
+        create_totp_and_static(john)
+    assert user_has_valid_totp_device(john) == confirmed
+
+    # A change that's rolled back doesn't change the cached status.
+    with contextlib.suppress(RuntimeError), transaction.atomic():
+        if confirmed:
+            john.totpdevice_set.all().delete()
+        else:
+            john.totpdevice_set.create(confirmed=True)
+        raise RuntimeError
+    assert john.totpdevice_set.exists() == confirmed
+    user = get_user_model().objects.get(pk=john.pk)
+    assert user_has_valid_totp_device(user) == confirmed
+
+
+def test_has_valid_totp_device_cache_concurrent_change(
+    john_with_totp,
+    status_cache,
+    django_capture_on_commit_callbacks,
+):
+    user, totp_device, static_device = john_with_totp
+    generation = get_device_generation(user.pk, create=True)
+    with django_capture_on_commit_callbacks(execute=True):
+        totp_device.delete()
+    # A lookup that started before the change caches what it found then...
+    status_cache.set(get_status_cache_key(user.pk), (generation, True))
+    # ...but that's ignored, as the generation has changed.
+    user = get_user_model().objects.get(pk=user.pk)
+    assert not user_has_valid_totp_device(user)
+
+
+def test_has_valid_totp_device_cache_unchanged_status(
+    client,
+    john_with_totp,
+    status_cache,
+    django_capture_on_commit_callbacks,
+):
+    user, totp_device, static_device = john_with_totp
+    assert user_has_valid_totp_device(user)
+    generation = get_device_generation(user.pk)
+    cached = (generation, True)
+    assert status_cache.get(get_status_cache_key(user.pk)) == cached
+
+    # Neither setting up (nor cleaning up) unconfirmed devices, nor saving a
+    # confirmed device without unconfirming it changes the user's 2FA status.
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        client.force_login(user)
+        client.get(reverse("two-factor-setup"))
+        TOTPDevice.objects.filter(user=user, confirmed=False).delete()
+        device = TOTPDevice.objects.get(pk=totp_device.pk)
+        assert not device.verify_token("000000")
+        device.throttle_reset()
+    assert not callbacks
+    assert status_cache.get(get_status_cache_key(user.pk)) == cached
+    assert get_device_generation(user.pk) == generation
+
+    with django_capture_on_commit_callbacks(execute=True):
+        device.confirmed = False
+        device.save()
+    assert status_cache.get(get_status_cache_key(user.pk)) is None
+    assert get_device_generation(user.pk) != generation
+
+
+def test_has_valid_totp_device_per_request(client, john_with_totp, settings):
+    user, totp_device, static_device = john_with_totp
+    settings.MIDDLEWARE += ("tests.test_allauth_2fa.Require2FA",)
+    client.force_login(user)
+    # The session, the user and the 2FA status, which is looked up only once
+    # even though both the middleware and the view check it.
+    with CaptureQueriesContext(connection) as queries:
+        resp = client.get(reverse("two-factor-remove"))
+    assert resp.status_code == 200
+    assert flows.count_queries(queries.captured_queries) == 3
+
+
+def test_require_2fa_middleware_satisfied_marker(
+    client,
+    john_with_totp,
+    settings,
+    django_assert_num_queries,
+    status_cache,
+    django_capture_on_commit_callbacks,
+):
+    user, totp_device, static_device = john_with_totp
+    settings.MIDDLEWARE += ("tests.test_allauth_2fa.Require2FA",)
+    client.force_login(user)
+    resp = client.get("/unnamed-view")
+    assert resp.status_code == 200
+    assert SATISFIED_SESSION_KEY in client.session
+
+    # Neither require_2fa nor the 2FA status are needed anymore; only the
+    # session and the user are loaded (and the device generation is read from
+    # the cache).
+    with patch.object(Require2FA, "require_2fa") as require_2fa:
+        with django_assert_num_queries(2):
+            resp = client.get("/unnamed-view")
+        require_2fa.assert_not_called()
+    assert resp.status_code == 200
+
+    # Changing the password (and so the session's auth hash, as in
+    # `update_session_auth_hash`) invalidates the marker.
+    user.set_password("new password")
+    user.save()
+    session = client.session
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    with patch.object(Require2FA, "require_2fa", return_value=True) as require_2fa:
+        client.get("/unnamed-view")
+        require_2fa.assert_called_once()
+
+    # Removing the device elsewhere invalidates the marker.
+    with django_capture_on_commit_callbacks(execute=True):
+        totp_device.delete()
+    resp = client.get("/unnamed-view")
+    assertRedirects(resp, TWO_FACTOR_SETUP_URL, fetch_redirect_response=False)
+
+
+def test_require_2fa_middleware_no_marker_without_status_cache(
+    client,
+    john_with_totp,
+    settings,
+):
+    user, totp_device, static_device = john_with_totp
+    settings.MIDDLEWARE += ("tests.test_allauth_2fa.Require2FA",)
+    client.force_login(user)
+    resp = client.get("/unnamed-view")
+    assert resp.status_code == 200
+    # Nothing would invalidate the marker if the device were removed elsewhere.
+    assert SATISFIED_SESSION_KEY not in client.session
+
+    totp_device.delete()
+    resp = client.get("/unnamed-view")
+    assertRedirects(resp, TWO_FACTOR_SETUP_URL, fetch_redirect_response=False)
+
+
+def test_remove_2fa_forgets_satisfied_marker(
+    client,
+    john_with_totp,
+    settings,
+    status_cache,
+    django_capture_on_commit_callbacks,
+):
+    user, totp_device, static_device = john_with_totp
+    settings.MIDDLEWARE += ("tests.test_allauth_2fa.Require2FA",)
+    client.force_login(user)
+    client.get("/unnamed-view")
+    assert SATISFIED_SESSION_KEY in client.session
+    token = get_token_from_totp_device(totp_device)
+    with django_capture_on_commit_callbacks(execute=True):
+        client.post(reverse("two-factor-remove"), {"otp_token": token})
+    assert SATISFIED_SESSION_KEY not in client.session
+    resp = client.get("/unnamed-view")
+    assertRedirects(resp, TWO_FACTOR_SETUP_URL, fetch_redirect_response=False)
+
+
+def test_authenticate_paths_follow_urlconf_changes():
+    def authenticate_view(request):
+        return HttpResponse()
+
+    urlconf = ModuleType("authenticate_paths_urls")
+    urlconf.urlpatterns = [
+        path("a/", authenticate_view, name="two-factor-authenticate"),
+    ]
+    with override_settings(ROOT_URLCONF=urlconf):
+        assert get_authenticate_paths(urlconf) == {"/a/"}
+    urlconf.urlpatterns = [
+        path("b/", authenticate_view, name="two-factor-authenticate"),
+    ]
+    # Changing the URLconf setting, or clearing the URL caches, drops the
+    # cached paths.
+    with override_settings(ROOT_URLCONF=urlconf):
+        assert get_authenticate_paths(urlconf) == {"/b/"}
+    urlconf.urlpatterns = []
+    clear_url_caches()
+    assert get_authenticate_paths(urlconf) == frozenset()
+
+
+def test_2fa_reset_flow_unknown_page(client, john_with_totp):
+    """Navigating to a page that doesn't exist also resets the login flow."""
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    resp = client.get("/does-not-exist")
+    assert resp.status_code == 404
+    assert not client.session.get("allauth_2fa_user_id")
+
+
+def test_2fa_middleware_skips_work_without_pending_login(
+    client,
+    john,
+    django_assert_num_queries,
+):
+    with patch("allauth_2fa.middleware.resolve") as resolve_mock:
+        # No session cookie: the session isn't even loaded.
+        with django_assert_num_queries(0):
+            client.get("/unnamed-view")
+
+        # No pending login: the URL isn't resolved.
+        client.force_login(john)
+        client.get("/unnamed-view")
+    resolve_mock.assert_not_called()
+
+
+def test_2fa_middleware_authenticate_paths(client, john_with_totp):
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    with patch("allauth_2fa.middleware.resolve") as resolve_mock:
+        client.get(TWO_FACTOR_AUTH_URL)
+    # The authenticate page is known without resolving its URL.
+    resolve_mock.assert_not_called()
+    assert client.session.get("allauth_2fa_user_id")
+
+
+@pytest.fixture()
+def async_client_sync():
+    """An AsyncClient (i.e. requests go through the ASGI handler) usable
+    from sync tests."""
+    client = AsyncClient()
+
+    class SyncWrapper:
+        def __getattr__(self, name):
+            attr = getattr(client, name)
+            if name not in ("get", "post"):
+                return attr
+
+            async def request(*args, **kwargs):
+                return await attr(*args, **kwargs)
+
+            return async_to_sync(request)
+
+    return SyncWrapper()
+
+
+class Require2FAWithAllowList(Require2FA):
+    allowed_namespaces = ["public"]
+    allowed_path_prefixes = ["/unnamed-"]
+    allowed_path_patterns = [r"/accounts/(?:inactive|signup)/$"]
+
+
+@pytest.mark.parametrize(
+    ("path", "allowed"),
+    [
+        (TWO_FACTOR_SETUP_URL, True),
+        ("/public/page", True),
+        ("/unnamed-view", True),
+        ("/accounts/inactive/", True),
+        ("/login-required-view", False),
+        ("/accounts/email/", False),
+    ],
+)
+def test_require_2fa_middleware_allowed_pages(client, john, settings, path, allowed):
+    settings.MIDDLEWARE += ("tests.test_allauth_2fa.Require2FAWithAllowList",)
+    client.force_login(john)
+    with patch.object(Require2FAWithAllowList, "require_2fa") as require_2fa:
+        require_2fa.return_value = True
+        resp = client.get(path)
+    if allowed:
+        # The cheap allow-list check is done before anything else.
+        require_2fa.assert_not_called()
+        assert resp.status_code != 302 or resp.url != TWO_FACTOR_SETUP_URL
+    else:
+        assertRedirects(resp, TWO_FACTOR_SETUP_URL, fetch_redirect_response=False)
+
+
+def test_middlewares_are_async_native():
+    async def get_response(request):
+        return HttpResponse()
+
+    middleware = Require2FA(get_response)
+    assert asyncio.iscoroutinefunction(middleware.process_view)
+
+    middleware = Require2FA(lambda request: HttpResponse())
+    assert not asyncio.iscoroutinefunction(middleware.process_view)
+
+
+@pytest.mark.parametrize(
+    ("path", "expect_reset"),
+    [(TWO_FACTOR_AUTH_URL, False), ("/unnamed-view", True)],
+)
+def test_2fa_reset_flow_async(path, expect_reset):
+    async def get_response(request):
+        return HttpResponse()
+
+    session = SessionStore()
+    session["allauth_2fa_user_id"] = "1"
+    session["allauth_2fa_device_ids"] = []
+    session["allauth_2fa_login_key"] = "key"
+    session.save()
+    cache_key = get_pending_login_cache_key("key")
+    caches["default"].set(cache_key, {})
+    request = AsyncRequestFactory().get(path)
+    request.COOKIES[settings.SESSION_COOKIE_NAME] = session.session_key
+    request.session = SessionStore(session.session_key)
+
+    middleware = AllauthTwoFactorMiddleware(get_response)
+    with override_settings(ALLAUTH_2FA_PENDING_LOGIN_CACHE="default"):
+        async_to_sync(middleware)(request)
+    for key in (
+        "allauth_2fa_user_id",
+        "allauth_2fa_device_ids",
+        "allauth_2fa_login_key",
+    ):
+        assert (key not in request.session) == expect_reset
+    assert (caches["default"].get(cache_key) is None) == expect_reset
+
+
+def test_2fa_reset_flow_async_overridden_hooks():
+    async def get_response(request):
+        return HttpResponse()
+
+    class CustomMiddleware(AllauthTwoFactorMiddleware):
+        def process_request(self, request):
+            request.processed = True
+            return super().process_request(request)
+
+        def process_response(self, request, response):
+            response["X-Processed"] = "yes"
+            return response
+
+    request = AsyncRequestFactory().get("/unnamed-view")
+    request.session = SessionStore()
+    response = async_to_sync(CustomMiddleware(get_response))(request)
+    assert request.processed
+    assert response["X-Processed"] == "yes"
+
+
+def test_require_2fa_middleware_async(async_client_sync, john, settings):
+    client = async_client_sync
+    settings.MIDDLEWARE += ("tests.test_allauth_2fa.Require2FA",)
+    client.force_login(john)
+    resp = client.get("/unnamed-view")
+    assertRedirects(resp, TWO_FACTOR_SETUP_URL, fetch_redirect_response=False)
+
+    create_totp_and_static(john)
+    resp = client.get("/unnamed-view")
+    assert resp.status_code == 200
+
+
+def test_async_views(async_client_sync, john, settings, user_logged_in_count):
+    settings.ROOT_URLCONF = "tests.async_urls"
+    client = async_client_sync
+    client.force_login(john)
+
+    # Set up a device; a wrong token replaces the device.
+    resp = client.get(TWO_FACTOR_SETUP_URL)
+    assert resp.status_code == 200
+    device = john.totpdevice_set.get()
+    resp = client.post(TWO_FACTOR_SETUP_URL, {"otp_token": "hernekeitto"})
+    assert resp.status_code == 200
+    assert not john.totpdevice_set.filter(pk=device.pk).exists()
+    device = john.totpdevice_set.get()
+    resp = client.post(
+        TWO_FACTOR_SETUP_URL,
+        {"otp_token": get_token_from_totp_device(device)},
+    )
+    assertRedirects(resp, TWO_FACTOR_BACKUP_TOKENS_URL, fetch_redirect_response=False)
+    assert john.totpdevice_set.get().confirmed
+
+    resp = client.post(TWO_FACTOR_BACKUP_TOKENS_URL)
+    tokens = [token.token for token in resp.context_data["backup_tokens"]]
+    assert len(tokens) == 3
+
+    # Log in again using a backup token.
+    client.logout()
+    resp = client.post(LOGIN_URL, JOHN_CREDENTIALS)
+    assertRedirects(resp, TWO_FACTOR_AUTH_URL, fetch_redirect_response=False)
+    resp = client.get(TWO_FACTOR_AUTH_URL)
+    assert resp.status_code == 200
+    resp = client.post(TWO_FACTOR_AUTH_URL, {"otp_token": tokens[0]})
+    assertRedirects(resp, settings.LOGIN_REDIRECT_URL, fetch_redirect_response=False)
+    assert user_logged_in_count() == 1
+
+    # Remove 2FA using another backup token.
+    resp = client.get(reverse("two-factor-remove"))
+    assert resp.status_code == 200
+    client.post(reverse("two-factor-remove"), {"otp_token": tokens[1]})
+    assert not john.totpdevice_set.exists()
+
+
+def test_async_setup_key_in_session(async_client_sync, john, settings):
+    settings.ROOT_URLCONF = "tests.async_urls"
+    settings.ALLAUTH_2FA_SETUP_KEY_IN_SESSION = True
+    client = async_client_sync
+    client.force_login(john)
+
+    resp = client.get(TWO_FACTOR_SETUP_URL)
+    assert resp.status_code == 200
+    assert not john.totpdevice_set.exists()
+    device = TOTPDevice(key=client.session["allauth_2fa_setup_key"])
+    resp = client.post(
+        TWO_FACTOR_SETUP_URL,
+        {"otp_token": get_token_from_totp_device(device)},
+    )
+    assertRedirects(resp, TWO_FACTOR_BACKUP_TOKENS_URL, fetch_redirect_response=False)
+    assert john.totpdevice_set.get().key == device.key
+
+
+def test_2fa_login_device_ids(client, john_with_totp):
+    """The pending login remembers the user's devices, and only those are
+    looked up when verifying the token."""
+    user, totp_device, static_device = john_with_totp
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    assert client.session["allauth_2fa_device_ids"] == {
+        "totp": [totp_device.pk],
+        "static": [static_device.pk],
+    }
+
+    with CaptureQueriesContext(connection) as queries:
+        do_totp_authentication(
+            client,
+            totp_device=totp_device,
+            expected_redirect_url=settings.LOGIN_REDIRECT_URL,
+        )
+    # The TOTP token matched, so the static devices weren't queried.
+    assert not any(
+        StaticDevice._meta.db_table in query["sql"]
+        for query in queries.captured_queries
+    )
+
+
+def test_2fa_login_static_token_device_ids(client, john_with_totp):
+    user, totp_device, static_device = john_with_totp
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    resp = client.post(
+        TWO_FACTOR_AUTH_URL,
+        {"otp_token": static_device.token_set.get().token},
+    )
+    assertRedirects(resp, settings.LOGIN_REDIRECT_URL, fetch_redirect_response=False)
+    assert not static_device.token_set.exists()
+
+
+def test_2fa_login_without_device_ids(client, john_with_totp):
+    """Logins stashed without the device IDs can still be completed."""
+    user, totp_device, static_device = john_with_totp
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    session = client.session
+    del session["allauth_2fa_device_ids"]
+    session.save()
+    do_totp_authentication(
+        client,
+        totp_device=totp_device,
+        expected_redirect_url=settings.LOGIN_REDIRECT_URL,
+    )
+
+
+def test_migration_management_command_batches(django_assert_max_num_queries):
+    from allauth.mfa.models import Authenticator
+
+    users = []
+    for x in range(10):
+        user = get_user_model().objects.create(username=f"user{x}")
+        create_totp_and_static(user)
+        users.append(user)
+
+    # Dry runs don't create anything.
+    stdout = StringIO()
+    call_command("allauth_2fa_migrate", "--dry-run", stdout=stdout)
+    assert "Would have created 20 Authenticators" in stdout.getvalue()
+    assert not Authenticator.objects.exists()
+
+    # Resume after the fourth user, 3 users at a time; the number of queries
+    # per batch is constant.
+    stdout = StringIO()
+    with django_assert_max_num_queries(2 * 8 + 1):
+        call_command(
+            "allauth_2fa_migrate",
+            "--batch-size=3",
+            f"--start-after-user-id={users[3].pk}",
+            stdout=stdout,
+        )
+    assert "Created 12 Authenticators" in stdout.getvalue()
+    assert "rows/s" in stdout.getvalue()
+    assert set(Authenticator.objects.values_list("user_id", flat=True)) == {
+        user.pk for user in users[4:]
+    }
+    recovery_codes = Authenticator.objects.get(
+        user=users[4],
+        type=Authenticator.Type.RECOVERY_CODES,
+    )
+    assert recovery_codes.data["migrated_codes"] == [
+        users[4].staticdevice_set.get().token_set.get().token,
+    ]
+
+
+def test_migration_management_command_incremental(django_assert_num_queries):
+    from allauth.mfa.models import Authenticator
+
+    users = [get_user_model().objects.create(username=f"user{x}") for x in range(4)]
+    for user in users[:2]:
+        create_totp_and_static(user)
+    call_command("allauth_2fa_migrate")
+    assert Authenticator.objects.count() == 4
+
+    # With nothing new to migrate, only the selection query is run.
+    stdout = StringIO()
+    with django_assert_num_queries(1):
+        call_command("allauth_2fa_migrate", stdout=stdout)
+    assert "Created 0 Authenticators" in stdout.getvalue()
+
+    # Only the new enrollments are migrated on the next run.
+    for user in users[2:]:
+        create_totp_and_static(user)
+    stdout = StringIO()
+    call_command("allauth_2fa_migrate", stdout=stdout)
+    assert "Created 4 Authenticators" in stdout.getvalue()
+    assert Authenticator.objects.count() == 8
+
+
+def test_migration_management_command_concurrent_changes():
+    from allauth.mfa.models import Authenticator
+
+    from allauth_2fa.management.commands.allauth_2fa_migrate import migrate_users
+
+    users = [get_user_model().objects.create(username=f"user{x}") for x in range(3)]
+    for user in users:
+        create_totp_and_static(user)
+    user_ids = [user.pk for user in users]
+
+    # In the meantime, the first user was migrated by another run, and the
+    # second one disabled 2FA; only what's actually created is counted.
+    Authenticator.objects.create(
+        user=users[0],
+        type=Authenticator.Type.TOTP,
+        data={},
+    )
+    users[1].totpdevice_set.all().delete()
+    assert migrate_users(user_ids, dry_run=False) == 3
+    assert migrate_users(user_ids, dry_run=False) == 0
+    assert not Authenticator.objects.filter(user=users[1]).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_migration_management_command_workers(monkeypatch):
+    from allauth.mfa.models import Authenticator
+
+    from allauth_2fa.management.commands.allauth_2fa_migrate import Command
+
+    # The in-memory test database can't be shared with other processes, and
+    # SQLite doesn't allow concurrent writes; run the batches inline.
+    class InlineExecutor(Executor):
+        def __init__(self, max_workers, mp_context, initializer):
+            # The workers don't inherit this process's database connections.
+            assert mp_context.get_start_method() == "spawn"
+            initializer()
+
+        def submit(self, fn, *args):
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+
+    monkeypatch.setattr(Command, "executor_class", InlineExecutor)
+
+    for x in range(10):
+        user = get_user_model().objects.create(username=f"user{x}")
+        create_totp_and_static(user)
+    call_command("allauth_2fa_migrate", "--batch-size=2", "--workers=3")
+    auth_qs = Authenticator.objects
+    assert auth_qs.filter(type=Authenticator.Type.RECOVERY_CODES).count() == 10
+    assert auth_qs.filter(type=Authenticator.Type.TOTP).count() == 10
+
+    # Running the migration again doesn't change anything.
+    call_command("allauth_2fa_migrate", "--batch-size=2", "--workers=3")
+    assert auth_qs.count() == 20
+
+
+def test_qr_code_svg():
+    device = TOTPDevice(key="00" * 20)
+    kwargs = {"issuer": "Example", "label": "Example: john"}
+    svg = generate_totp_config_svg(device, **kwargs)
+
+    # The path draws exactly the dark modules of the QR code.
+    qr = qrcode.QRCode()
+    qr.add_data(get_totp_config_url(device, **kwargs))
+    qr.make(fit=True)
+    expected = qr.get_matrix()
+    size = len(expected)
+    root = ElementTree.fromstring(svg)  # noqa: S314
+    assert root.get("viewBox") == f"0 0 {size} {size}"
+    assert root.get("width") == f"{size}mm"
+    matrix = [[False] * size for _ in range(size)]
+    path = root.find("{http://www.w3.org/2000/svg}path").get("d")
+    for x, y, width in re.findall(r"M(\d+) (\d+)h(\d+)", path):
+        for dx in range(int(width)):
+            matrix[int(y)][int(x) + dx] = True
+    assert matrix == expected
+
+    # The result is memoized on the device while its configuration stays the
+    # same, but not shared with other instances, as it encodes the secret.
+    assert generate_totp_config_svg(device, **kwargs) is svg
+    same_key_device = TOTPDevice(key=device.key)
+    assert generate_totp_config_svg(same_key_device, **kwargs) is not svg
+    other = generate_totp_config_svg(
+        device,
+        **kwargs,
+        error_correction=qrcode.constants.ERROR_CORRECT_H,
+        box_size=5,
+    )
+    assert other != svg
+    device.key = "11" * 20
+    assert generate_totp_config_svg(device, **kwargs) != svg
+
+
+def test_setup_qr_code_view(client, john, settings):
+    settings.ALLAUTH_2FA_SETUP_QR_CODE_INLINE = False
+    qr_code_url = reverse("two-factor-setup-qr")
+    client.force_login(john)
+
+    # There's no QR code until the setup page has created a device.
+    assert client.get(qr_code_url).status_code == 404
+
+    resp = client.get(TWO_FACTOR_SETUP_URL)
+    assert resp.context["qr_code_url"] == qr_code_url
+    assert b"data:image/svg+xml" not in resp.content
+
+    resp = client.get(qr_code_url)
+    assert resp.status_code == 200
+    assert resp["Content-Type"] == "image/svg+xml"
+    assert resp.content == generate_totp_config_svg(
+        john.totpdevice_set.get(),
+        issuer="example.com",
+        label="example.com: john",
+    )
+    assert "private" in resp["Cache-Control"]
+    assert "no-cache" in resp["Cache-Control"]
+    etag = resp["ETag"]
+
+    # The QR code is only sent again if the device has changed.
+    resp = client.get(qr_code_url, HTTP_IF_NONE_MATCH=etag)
+    assert resp.status_code == 304
+    client.get(TWO_FACTOR_SETUP_URL)
+    resp = client.get(qr_code_url, HTTP_IF_NONE_MATCH=etag)
+    assert resp.status_code == 200
+    assert resp["ETag"] != etag
+
+    assert client.get(qr_code_url, {"format": "gif"}).status_code == 404
+
+
+def test_setup_qr_code_view_png(client, john):
+    pytest.importorskip("PIL")
+    client.force_login(john)
+    client.get(TWO_FACTOR_SETUP_URL)
+    resp = client.get(reverse("two-factor-setup-qr"), {"format": "png"})
+    assert resp.status_code == 200
+    assert resp["Content-Type"] == "image/png"
+    assert resp.content.startswith(b"\x89PNG")
+
+
+def test_cleanup_management_command(monkeypatch):
+    now = timezone.now()
+    users = [get_user_model().objects.create(username=f"user{x}") for x in range(6)]
+    old = [user.totpdevice_set.create(confirmed=False) for user in users[:3]]
+    TOTPDevice.objects.filter(pk__in=[d.pk for d in old]).update(
+        created_at=now - timedelta(days=2),
+    )
+    undated = users[3].totpdevice_set.create(confirmed=False)
+    TOTPDevice.objects.filter(pk=undated.pk).update(created_at=None)
+    recent = users[4].totpdevice_set.create(confirmed=False)
+    confirmed = users[5].totpdevice_set.create(confirmed=True)
+    TOTPDevice.objects.filter(pk=confirmed.pk).update(
+        created_at=now - timedelta(days=2),
+    )
+
+    stdout = StringIO()
+    call_command("allauth_2fa_cleanup", "--dry-run", stdout=stdout)
+    assert "Would have deleted 4 unconfirmed devices" in stdout.getvalue()
+    assert TOTPDevice.objects.count() == 6
+
+    sleep = Mock()
+    monkeypatch.setattr("time.sleep", sleep)
+    stdout = StringIO()
+    call_command(
+        "allauth_2fa_cleanup",
+        "--batch-size=3",
+        "--sleep=0.5",
+        stdout=stdout,
+    )
+    assert "Deleted 4 unconfirmed devices" in stdout.getvalue()
+    assert "rows/s" in stdout.getvalue()
+    assert sleep.call_count == 2
+    assert set(TOTPDevice.objects.values_list("pk", flat=True)) == {
+        recent.pk,
+        confirmed.pk,
+    }
+
+
+@pytest.fixture()
+def metrics(settings):
+    settings.ALLAUTH_2FA_METRICS_BACKEND = (
+        "allauth_2fa.instrumentation.HistogramMetricsBackend"
+    )
+    backend = get_metrics_backend()
+    backend.reset()
+    return backend
+
+
+def test_metrics(client, john_with_totp, metrics, settings):
+    user, totp_device, static_device = john_with_totp
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    assert metrics.count("pre_login", "2fa_required") == 1
+    assert metrics.queries("pre_login") > 0
+
+    # The first wrong token throttles the devices.
+    client.post(TWO_FACTOR_AUTH_URL, {"otp_token": "123456"})
+    assert metrics.count("authenticate.verify_token", "invalid_token") == 1
+    client.post(TWO_FACTOR_AUTH_URL, {"otp_token": "123456"})
+    assert metrics.count("authenticate.verify_token", "throttled") == 1
+
+    TOTPDevice.objects.update(throttling_failure_count=0)
+    StaticDevice.objects.update(throttling_failure_count=0)
+    do_totp_authentication(
+        client,
+        totp_device=totp_device,
+        expected_redirect_url=settings.LOGIN_REDIRECT_URL,
+    )
+    assert metrics.count("authenticate.verify_token", "success") == 1
+    assert metrics.count("authenticate.complete_login", "success") == 1
+    assert metrics.count("authenticate.verify_token") == 3
+    assert sum(metrics.histogram("authenticate.verify_token")) == 3
+
+    # The pending login is reset when navigating away.
+    client.logout()
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    client.get("/unnamed-view")
+    assert metrics.count("reset_pending_login_middleware", "reset") == 1
+
+    # The middleware is loaded with the first request; use a new client.
+    settings.MIDDLEWARE += ("tests.test_allauth_2fa.Require2FA",)
+    client = Client()
+    client.force_login(user)
+    client.get("/unnamed-view")
+    assert metrics.count("require_2fa_middleware", "2fa_enabled") == 1
+
+
+def test_metrics_qr_code(client, john, metrics):
+    client.force_login(john)
+    client.get(TWO_FACTOR_SETUP_URL)
+    assert metrics.count("qr_code.svg", "success") == 1
+
+
+def test_metrics_disabled(client, john_with_totp):
+    assert not get_metrics_backend().enabled
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+
+
+def test_app_settings_snapshot():
+    snapshot = app_settings.get_app_settings()
+    assert app_settings.get_app_settings() is snapshot
+    # The values are plain module globals once resolved.
+    assert vars(app_settings)["BACKUP_TOKENS_NUMBER"] == 3
+    with pytest.raises(FrozenInstanceError):
+        snapshot.BACKUP_TOKENS_NUMBER = 5
+
+    # Changing a setting refreshes the snapshot.
+    with override_settings(ALLAUTH_2FA_BACKUP_TOKENS_NUMBER=5):
+        assert app_settings.BACKUP_TOKENS_NUMBER == 5
+        assert app_settings.get_app_settings() is not snapshot
+    assert app_settings.BACKUP_TOKENS_NUMBER == 3
+
+    with pytest.raises(AttributeError):
+        app_settings.NOT_A_SETTING  # noqa: B018
+
+
+def test_settings_checks(settings):
+    assert check_settings(None) == []
+
+    settings.ALLAUTH_2FA_FORMS = {"setup": "tests.forms.CustomSetupForm", "x": ""}
+    settings.ALLAUTH_2FA_BACKUP_TOKENS_NUMBER = 0
+    settings.ALLAUTH_2FA_STATUS_CACHE = "nope"
+    settings.ALLAUTH_2FA_STATUS_CACHE_TIMEOUT = "300"
+    settings.ALLAUTH_2FA_METRICS_BACKEND = "tests.nope.Backend"
+    assert [error.id for error in check_settings(None)] == [
+        "allauth_2fa.E002",
+        "allauth_2fa.E003",
+        "allauth_2fa.E004",
+        "allauth_2fa.E005",
+        "allauth_2fa.E006",
+    ]
+
+    settings.ALLAUTH_2FA_FORMS = ["setup"]
+    assert [error.id for error in check_settings(None)] == ["allauth_2fa.E001"]
+
+
+@pytest.fixture(params=["LocalRateLimiter", "CacheRateLimiter"])
+def rate_limiter(request, settings):
+    settings.ALLAUTH_2FA_RATE_LIMITER = f"allauth_2fa.ratelimit.{request.param}"
+    settings.ALLAUTH_2FA_RATE_LIMIT_ATTEMPTS = 3
+    settings.ALLAUTH_2FA_RATE_LIMIT_WINDOW = 60
+    # Start from a clean slate.
+    _load_rate_limiter.cache_clear()
+    caches["default"].clear()
+    yield get_rate_limiter()
+    _load_rate_limiter.cache_clear()
+    caches["default"].clear()
+
+
+def test_rate_limiter_window(rate_limiter):
+    keys = ["user:1", "ip:127.0.0.1"]
+    with patch("time.time", return_value=1000.0), patch(
+        "time.monotonic",
+        return_value=1000.0,
+    ):
+        for _i in range(3):
+            assert not rate_limiter.is_limited(keys)
+            rate_limiter.record_failure(keys)
+        assert rate_limiter.is_limited(keys)
+        assert rate_limiter.is_limited(["ip:127.0.0.1"])
+        assert not rate_limiter.is_limited(["user:2"])
+    # The failures drop out of the window.
+    with patch("time.time", return_value=1121.0), patch(
+        "time.monotonic",
+        return_value=1121.0,
+    ):
+        assert not rate_limiter.is_limited(keys)
+
+
+def test_local_rate_limiter_drops_stale_keys(settings):
+    settings.ALLAUTH_2FA_RATE_LIMIT_WINDOW = 60
+    rate_limiter = LocalRateLimiter()
+    with patch("time.monotonic", return_value=1000.0):
+        for x in range(100):
+            rate_limiter.record_failure([f"ip:10.0.0.{x}"])
+    # Keys that are never seen again don't stay around forever.
+    with patch("time.monotonic", return_value=1061.0):
+        rate_limiter.record_failure(["user:1"])
+    assert list(rate_limiter._failures) == ["user:1"]
+
+
+def test_2fa_login_rate_limited(
+    client,
+    john_with_totp,
+    rate_limiter,
+    metrics,
+    django_assert_num_queries,
+):
+    user, totp_device, static_device = john_with_totp
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    for _i in range(3):
+        resp = client.post(TWO_FACTOR_AUTH_URL, {"otp_token": "123456"})
+        assert resp.status_code == 200
+
+    # Even the right token is turned away now, without touching the devices.
+    form = TOTPAuthenticateForm(
+        user=user,
+        device_ids=get_device_ids(user),
+        data={"otp_token": get_token_from_totp_device(totp_device)},
+    )
+    with django_assert_num_queries(0):
+        assert not form.is_valid()
+    assert form.has_error("__all__", "rate_limited")
+
+    # So is the right token entered in the view.
+    resp = client.post(
+        TWO_FACTOR_AUTH_URL,
+        {"otp_token": get_token_from_totp_device(totp_device)},
+    )
+    assert resp.status_code == 200
+    assert "Too many failed attempts" in resp.content.decode()
+    assert metrics.count("authenticate.verify_token", "rate_limited") == 2
+
+
+def test_remove_2fa_rate_limited(client, john_with_totp, rate_limiter):
+    user, totp_device, static_device = john_with_totp
+    client.force_login(user)
+    for _i in range(3):
+        client.post(reverse("two-factor-remove"), {"otp_token": "123456"})
+    resp = client.post(
+        reverse("two-factor-remove"),
+        {"otp_token": get_token_from_totp_device(totp_device)},
+    )
+    assert resp.status_code == 200
+    assert "Too many failed attempts" in resp.content.decode()
+    assert user.totpdevice_set.exists()
+
+
+@pytest.fixture()
+def replay_cache(settings):
+    settings.ALLAUTH_2FA_TOTP_REPLAY_CACHE = "default"
+    caches["default"].clear()
+    flush_device_usage()
+    yield caches["default"]
+    flush_device_usage()
+    caches["default"].clear()
+
+
+def test_2fa_login_replay_cache(client, john_with_totp, replay_cache):
+    user, totp_device, static_device = john_with_totp
+    token = get_token_from_totp_device(totp_device)
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    with CaptureQueriesContext(connection) as queries:
+        do_totp_authentication(
+            client,
+            totp_device=totp_device,
+            expected_redirect_url=settings.LOGIN_REDIRECT_URL,
+        )
+    # The device isn't saved...
+    assert not any(
+        query["sql"].startswith('UPDATE "otp_totp_totpdevice"')
+        for query in queries.captured_queries
+    )
+    totp_device.refresh_from_db()
+    assert totp_device.last_t == -1
+    assert totp_device.last_used_at is None
+
+    # ...but the token can't be used again.
+    client.logout()
+    login(client, expected_redirect_url=TWO_FACTOR_AUTH_URL)
+    resp = client.post(TWO_FACTOR_AUTH_URL, {"otp_token": token})
+    assert resp.status_code == 200
+    assert "_auth_user_id" not in client.session
+
+    # The usage is saved later.
+    assert flush_device_usage() == 1
+    totp_device.refresh_from_db()
+    assert totp_device.last_t > 0
+    assert totp_device.last_used_at is not None
+
+
+def test_replay_cache_all_forms(john_with_totp, replay_cache):
+    user, totp_device, static_device = john_with_totp
+    token = get_token_from_totp_device(totp_device)
+    form = TOTPAuthenticateForm(
+        user=user,
+        device_ids=get_device_ids(user),
+        data={"otp_token": token},
+    )
+    assert form.is_valid()
+
+    # The saved `last_t` isn't up to date yet, but the token is rejected by
+    # the other forms too.
+    for form in [
+        TOTPAuthenticateForm(user=user, data={"otp_token": token}),
+        TOTPDeviceRemoveForm(user=user, data={"otp_token": token}),
+    ]:
+        assert not form.is_valid()
+        assert form.has_error("__all__", "invalid_token")
+
+
+def test_replay_cache_flush_monotonic(john_with_totp, replay_cache):
+    user, totp_device, static_device = john_with_totp
+    assert verify_totp_device(totp_device, get_token_from_totp_device(totp_device))
+    # A newer time step is saved in the meantime.
+    newer_t = totp_device.last_t + 1
+    TOTPDevice.objects.filter(pk=totp_device.pk).update(last_t=newer_t)
+    assert flush_device_usage() == 1
+    totp_device.refresh_from_db()
+    assert totp_device.last_t == newer_t
+    assert totp_device.last_used_at is None
+
+
+def test_replay_cache_flush_batch_size(john_with_totp, replay_cache, settings):
+    user, totp_device, static_device = john_with_totp
+    settings.ALLAUTH_2FA_TOTP_USAGE_FLUSH_BATCH_SIZE = 1
+    assert verify_totp_device(totp_device, get_token_from_totp_device(totp_device))
+    totp_device.refresh_from_db()
+    assert totp_device.last_t > 0
+    assert flush_device_usage() == 0
+
+
+def test_get_2fa_statuses(django_assert_num_queries):
+    users = [get_user_model().objects.create(username=f"user{i}") for i in range(4)]
+    create_totp_and_static(users[1])
+    create_totp_and_static(users[3])
+    users[2].totpdevice_set.create(confirmed=False)
+    expected = {user.pk: user in (users[1], users[3]) for user in users}
+
+    with django_assert_num_queries(1):
+        assert get_2fa_statuses([user.pk for user in users]) == expected
+    with django_assert_num_queries(1):
+        assert get_2fa_statuses(get_user_model().objects.all()) == expected
+    with django_assert_num_queries(1):
+        annotated = list(with_2fa_status(get_user_model().objects.order_by("pk")))
+    assert [user.has_2fa for user in annotated] == list(expected.values())
+
+
+def test_admin_2fa_status(rf, john_with_totp):
+    user_model = get_user_model()
+    user_model.objects.create(username="jane")
+
+    class UserAdmin(TwoFactorStatusAdminMixin, admin.ModelAdmin):
+        list_display = ["username", "has_2fa"]
+
+    model_admin = UserAdmin(user_model, admin.AdminSite())
+    request = rf.get("/")
+    users = model_admin.get_queryset(request).order_by("username")
+    assert [model_admin.has_2fa(user) for user in users] == [False, True]
+
+    for value, expected in [("yes", ["john"]), ("no", ["jane"])]:
+        list_filter = TwoFactorStatusListFilter(
+            request,
+            {"has_2fa": value},
+            user_model,
+            model_admin,
+        )
+        filtered = list_filter.queryset(request, user_model.objects.all())
+        assert [user.username for user in filtered] == expected
+
+
+@pytest.fixture()
+def status_table(settings):
+    settings.ALLAUTH_2FA_STATUS_TABLE = True
+
+
+def test_status_table_lookup(john, status_table, django_assert_num_queries):
+    # Not recorded yet: looked up from the devices, and recorded.
+    with django_assert_num_queries(3):
+        assert not user_has_valid_totp_device(john)
+    assert not TwoFactorStatus.objects.get(pk=john.pk).has_2fa
+
+    create_totp_and_static(john)
+    assert TwoFactorStatus.objects.get(pk=john.pk).has_2fa
+    user = get_user_model().objects.get(pk=john.pk)
+    # A primary key lookup.
+    with django_assert_num_queries(1) as captured:
+        assert user_has_valid_totp_device(user)
+    assert "allauth_2fa_twofactorstatus" in captured.captured_queries[0]["sql"]
+
+    # New users have their status recorded when they're created, so looking
+    # it up is a single read too.
+    other = get_user_model().objects.create(username="other")
+    with django_assert_num_queries(1):
+        assert not user_has_valid_totp_device(other)
+
+
+def test_async_status_table_lookup(john, status_table):
+    assert not async_to_sync(auser_has_valid_totp_device)(john)
+    assert not TwoFactorStatus.objects.get(pk=john.pk).has_2fa
+    create_totp_and_static(john)
+    user = get_user_model().objects.get(pk=john.pk)
+    assert async_to_sync(auser_has_valid_totp_device)(user)
+
+
+def test_status_table_consistency(client, john, settings, status_table):
+    def assert_consistent():
+        call_command("allauth_2fa_status", stdout=StringIO())
+
+    # An unconfirmed device doesn't change the status.
+    client.force_login(john)
+    client.get(TWO_FACTOR_SETUP_URL)
+    assert not TwoFactorStatus.objects.filter(pk=john.pk, has_2fa=True).exists()
+    assert_consistent()
+
+    device = john.totpdevice_set.get()
+    client.post(
+        TWO_FACTOR_SETUP_URL,
+        {"otp_token": get_token_from_totp_device(device)},
+    )
+    assert TwoFactorStatus.objects.get(pk=john.pk).has_2fa
+    assert_consistent()
+
+    # Saves that don't change whether the device is confirmed (e.g. throttling
+    # a failed attempt) don't touch the table.
+    device = TOTPDevice.objects.get(pk=device.pk)
+    with CaptureQueriesContext(connection) as queries:
+        assert not device.verify_token("000000")
+    assert len(queries.captured_queries) == 1
+    assert "allauth_2fa_twofactorstatus" not in queries.captured_queries[0]["sql"]
+
+    # The token has just been used, so don't require one.
+    settings.ALLAUTH_2FA_REQUIRE_OTP_ON_DEVICE_REMOVAL = False
+    client.post(reverse("two-factor-remove"))
+    assert not john.totpdevice_set.exists()
+    assert not TwoFactorStatus.objects.get(pk=john.pk).has_2fa
+    assert_consistent()
+
+
+# The foreign keys are only checked when the deletion is committed.
+@pytest.mark.django_db(transaction=True)
+def test_status_table_user_delete(john, status_table):
+    create_totp_and_static(john)
+    assert TwoFactorStatus.objects.get(pk=john.pk).has_2fa
+    john.delete()
+    assert not TwoFactorStatus.objects.exists()
+
+    # Deleting a device doesn't record a missing status either.
+    other = get_user_model().objects.create(username="other")
+    create_totp_and_static(other)
+    TwoFactorStatus.objects.all().delete()
+    other.totpdevice_set.all().delete()
+    assert not TwoFactorStatus.objects.exists()
+
+
+@pytest.mark.parametrize("supports_update_conflicts", (False, True))
+def test_upsert_2fa_statuses(john, monkeypatch, supports_update_conflicts):
+    if not supports_update_conflicts:
+        # e.g. Oracle; the rows are updated or created one by one.
+        for feature in (
+            "supports_update_conflicts",
+            "supports_update_conflicts_with_target",
+        ):
+            monkeypatch.setattr(connection.features, feature, False)
+    other = get_user_model().objects.create(username="other")
+    TwoFactorStatus.objects.create(user=john, has_2fa=False)
+    upsert_2fa_statuses({john.pk: True, other.pk: False})
+    assert dict(TwoFactorStatus.objects.values_list("pk", "has_2fa")) == {
+        john.pk: True,
+        other.pk: False,
+    }
+
+
+def test_status_management_command(status_table):
+    users = [get_user_model().objects.create(username=f"user{i}") for i in range(5)]
+    # New users get a status right away.
+    assert TwoFactorStatus.objects.filter(has_2fa=False).count() == 5
+    for user in users[:2]:
+        create_totp_and_static(user)
+    assert TwoFactorStatus.objects.filter(has_2fa=True).count() == 2
+
+    # Changes that bypass the signals make the statuses inconsistent.
+    TOTPDevice.objects.filter(user=users[0]).update(confirmed=False)
+    TwoFactorStatus.objects.filter(pk=users[1].pk).delete()
+    TwoFactorStatus.objects.filter(pk=users[2].pk).update(has_2fa=True)
+    TwoFactorStatus.objects.filter(pk=users[3].pk).delete()
+
+    stdout = StringIO()
+    with pytest.raises(CommandError, match="4 statuses don't match"):
+        call_command("allauth_2fa_status", stdout=stdout)
+    assert stdout.getvalue() == "1 users have 2FA enabled; 4 statuses don't match\n"
+
+    stdout = StringIO()
+    call_command("allauth_2fa_status", "--rebuild", "--batch-size=1", stdout=stdout)
+    assert stdout.getvalue().splitlines()[-1] == "Fixed 4 statuses"
+    # Every user has a status again.
+    assert dict(TwoFactorStatus.objects.values_list("pk", "has_2fa")) == {
+        user.pk: user == users[1] for user in users
+    }
+    call_command("allauth_2fa_status", stdout=StringIO())
@@ -20,4 +20,9 @@ urlpatterns = [
     # A view without a name.
     path("unnamed-view", blank_view),
     path("login-required-view", login_required_view, name="login-required-view"),
+    # Namespaced views.
+    path(
+        "public/",
+        include(([path("page", blank_view, name="page")], "public")),
+    ),
 ]